@@ -1,5 +1,8 @@
+import copy
 import datetime
+import itertools
 import logging
+import multiprocessing
 from collections import OrderedDict, defaultdict
 
 import numpy as np
@@ -7,18 +10,22 @@ from lvis.lvis import LVIS
 from lvis.results import LVISResults
 
 import pycocotools.mask as mask_utils
+from pycocotools.cocoeval import EvalImgs
+from pycocotools.kernels import bboxOverlaps, denseIous, greedyMatch
 
 
 class LVISEval:
-    def __init__(self, lvis_gt, lvis_dt, iou_type="segm"):
+    def __init__(self, lvis_gt, lvis_dt, iou_type="segm", num_workers=1):
         """Constructor for LVISEval.
         Args:
             lvis_gt (LVIS class instance,
                 or str containing path of annotation file)
             lvis_dt (LVISResult class instance,
                 or str containing path of result file,
-            or list of dict)
+            or list of dict, or None to only accumulate results loaded
+            with load_eval_imgs)
             iou_type (str): segm or bbox evaluation
+            num_workers (int): number of processes used by evaluate()
         """
         self.logger = logging.getLogger(__name__)
 
@@ -36,6 +43,8 @@ class LVISEval:
             self.lvis_dt = lvis_dt
         elif isinstance(lvis_dt, (str, list)):
             self.lvis_dt = LVISResults(self.lvis_gt, lvis_dt)
+        elif lvis_dt is None:
+            self.lvis_dt = None
         else:
             raise TypeError("Unsupported type {} of lvis_dt.".format(lvis_dt))
 
@@ -47,13 +56,13 @@ class LVISEval:
         self.params = Params(iou_type=iou_type)  # parameters
         self.results = OrderedDict()
         self.ious = {}  # ious between all gts and dts
+        self.num_workers = num_workers  # processes for per image evaluation
 
         self.params.img_ids = sorted(self.lvis_gt.get_img_ids())
         self.params.cat_ids = sorted(self.lvis_gt.get_cat_ids())
 
     def _to_mask(self, anns, lvis):
-        for ann in anns:
-            rle = lvis.ann_to_rle(ann)
+        for ann, rle in zip(anns, lvis.anns_to_rles(anns, self.num_workers)):
             ann["segmentation"] = rle
 
     def _prepare(self):
@@ -86,24 +95,26 @@ class LVISEval:
         # penalized for categories about which we don't have gt information
         # about their presence or absence in an image.
         img_data = self.lvis_gt.load_imgs(ids=self.params.img_ids)
-        # per image map of categories not present in image
-        img_nl = {d["id"]: d["neg_category_ids"] for d in img_data}
-        # per image list of categories present in image
+        # per image set of categories not present in image
+        img_nl = {d["id"]: set(d["neg_category_ids"]) for d in img_data}
+        # per image set of categories present in image
         img_pl = defaultdict(set)
         for ann in gts:
             img_pl[ann["image_id"]].add(ann["category_id"])
-        # per image map of categoires which have missing gt. For these
+        # per image set of categoires which have missing gt. For these
         # categories we don't penalize the detector for flase positives.
         self.img_nel = {
-            d["id"]: d["not_exhaustive_category_ids"]
+            d["id"]: set(d["not_exhaustive_category_ids"])
             for d in img_data
         }
 
-        for dt in dts:
-            img_id, cat_id = dt["image_id"], dt["category_id"]
-            if cat_id not in img_nl[img_id] and cat_id not in img_pl[img_id]:
-                continue
-            self._dts[img_id, cat_id].append(dt)
+        # look up the (image, category) pairs of all dt at once
+        known = np.union1d(_img_cat_keys(img_nl), _img_cat_keys(img_pl))
+        dt_keys = _pair_keys([dt["image_id"] for dt in dts],
+                             [dt["category_id"] for dt in dts])
+        keep = np.isin(dt_keys, known)
+        for dt in itertools.compress(dts, keep.tolist()):
+            self._dts[dt["image_id"], dt["category_id"]].append(dt)
 
         self.freq_groups = self._prepare_freq_group()
 
@@ -118,7 +129,7 @@ class LVISEval:
     def evaluate(self):
         """
         Run per image evaluation on given images and store results
-        (a list of dict) in self.eval_imgs.
+        (an LVISEvalImgs store) in self.eval_imgs.
         """
         self.logger.info("Running per image evaluation.")
         self.logger.info("Evaluate annotation type *{}*".format(
@@ -133,15 +144,134 @@ class LVISEval:
 
         self._prepare()
 
-        self.ious = {(img_id, cat_id): self.compute_iou(img_id, cat_id)
-                     for img_id in self.params.img_ids for cat_id in cat_ids}
+        self.ious = {}
+        self.eval_imgs = LVISEvalImgs(self.params.img_ids, cat_ids,
+                                      self.params.area_rng,
+                                      self.params.max_dets,
+                                      len(self.params.iou_thrs))
+        if self.num_workers > 1:
+            self._evaluate_parallel()
+        else:
+            self._evaluate_pairs()
 
-        # loop through images, area range, max detection number
-        self.eval_imgs = [
-            self.evaluate_img(img_id, cat_id, area_rng) for cat_id in cat_ids
-            for area_rng in self.params.area_rng
-            for img_id in self.params.img_ids
+    def _eval_pairs(self):
+        """List the (img_id, cat_id) pairs with gt or dt in the order of the
+        images, as (img_idx, cat_idx, img_id, cat_id). The results of all
+        other pairs are None, so they are neither computed nor stored.
+        """
+        img_idx = {img_id: i for i, img_id in enumerate(self.params.img_ids)}
+        if self.params.use_cats:
+            cat_idx = {
+                cat_id: k
+                for k, cat_id in enumerate(self.params.cat_ids)
+            }
+            # looked up with get, indexing would add empty lists
+            keys = [
+                key for key in set(self._gts) | set(self._dts)
+                if self._gts.get(key) or self._dts.get(key)
+            ]
+        else:
+            # all categories of an image are evaluated as one
+            cat_idx = {-1: 0}
+            keys = set((img_id, -1) for img_id, _ in self._gts)
+            keys |= set((img_id, -1) for img_id, _ in self._dts)
+        pairs = [(img_idx[img_id], cat_idx[cat_id], img_id, cat_id)
+                 for img_id, cat_id in keys
+                 if img_id in img_idx and cat_id in cat_idx]
+        return sorted(pairs, key=lambda pair: pair[:2])
+
+    def _evaluate_pairs(self):
+        """Compute self.ious and add the results of every pair with gt or dt
+        to self.eval_imgs.
+        """
+        num_area_rngs = len(self.params.area_rng)
+        num_imgs = len(self.params.img_ids)
+        cells, results = [], []
+        for img_idx, cat_idx, img_id, cat_id in self._eval_pairs():
+            self.ious[img_id, cat_id] = self.compute_iou(img_id, cat_id)
+            cells += [(cat_idx * num_area_rngs + area_idx) * num_imgs + img_idx
+                      for area_idx in range(num_area_rngs)]
+            if self.params.matcher == "vectorized":
+                # one match pass covers all area ranges
+                results += self.evaluate_img_areas(img_id, cat_id,
+                                                   self.params.area_rng)
+            elif self.params.matcher == "loop":
+                results += [
+                    self.evaluate_img(img_id, cat_id, area_rng)
+                    for area_rng in self.params.area_rng
+                ]
+            else:
+                raise ValueError("Unknown matcher for evaluation.")
+        self.eval_imgs.extend(cells, results)
+
+    def _evaluate_parallel(self):
+        """Shard the images over self.num_workers processes, each evaluating
+        the pairs of its images, and merge their results into
+        self.eval_imgs.
+        """
+        # a few shards per worker keep the processes evenly loaded
+        splits = [
+            split
+            for split in np.array_split(self.params.img_ids, self.num_workers *
+                                        4) if len(split) > 0
         ]
+        shard_idx = {
+            img_id: n
+            for n, split in enumerate(splits) for img_id in split
+        }
+        shards = []
+        for split in splits:
+            shard = copy.copy(self)
+            shard.lvis_gt, shard.lvis_dt = None, None
+            shard.params = copy.copy(self.params)
+            shard.params.img_ids = list(split)
+            shard._gts, shard._dts = defaultdict(list), defaultdict(list)
+            shard.img_nel = {img_id: self.img_nel[img_id] for img_id in split}
+            shards.append(shard)
+        for key, gt in self._gts.items():
+            if key[0] in shard_idx:
+                shards[shard_idx[key[0]]]._gts[key] = gt
+        for key, dt in self._dts.items():
+            if key[0] in shard_idx:
+                shards[shard_idx[key[0]]]._dts[key] = dt
+
+        workers = multiprocessing.Pool(processes=self.num_workers)
+        results = workers.map(_evaluate_shard, shards, chunksize=1)
+        workers.close()
+        workers.join()
+        for ious, eval_imgs in results:
+            self.ious.update(ious)
+            self.eval_imgs._merge(eval_imgs)
+
+    def pack_eval_imgs(self):
+        """Pack the per image evaluation results in self.eval_imgs into an
+        LVISEvalImgs store. Stores of disjoint sets of images can be merged
+        with += and serialized with tobytes(), e.g. to evaluate the images
+        in several processes and accumulate the merged results in one.
+        """
+        if isinstance(self.eval_imgs, LVISEvalImgs):
+            return self.eval_imgs
+        cat_ids = self.params.cat_ids if self.params.use_cats else [-1]
+        eval_imgs = LVISEvalImgs(self.params.img_ids, cat_ids,
+                                 self.params.area_rng, self.params.max_dets,
+                                 len(self.params.iou_thrs))
+        eval_imgs.extend(range(len(self.eval_imgs)), self.eval_imgs)
+        return eval_imgs
+
+    def load_eval_imgs(self, eval_imgs):
+        """Use an LVISEvalImgs store evaluated elsewhere in place of
+        evaluate(). The params must be those used to evaluate it, except for
+        img_ids which are taken from the store.
+        """
+        cat_ids = self.params.cat_ids if self.params.use_cats else [-1]
+        if (list(cat_ids) != eval_imgs.catIds
+                or not np.array_equal(self.params.area_rng, eval_imgs.areaRng)
+                or self.params.max_dets != eval_imgs.maxDet
+                or len(self.params.iou_thrs) != eval_imgs.T):
+            raise ValueError("eval_imgs were evaluated with different params.")
+        self.params.img_ids = list(eval_imgs.imgIds)
+        self.eval_imgs = eval_imgs
+        self.freq_groups = self._prepare_freq_group()
 
     def _get_gt_dt(self, img_id, cat_id):
         """Create gt, dt which are list of anns/dets. If use_cats is true
@@ -149,8 +279,8 @@ class LVISEval:
         used. Else, all anns/dets in image are used and cat_id is not used.
         """
         if self.params.use_cats:
-            gt = self._gts[img_id, cat_id]
-            dt = self._dts[img_id, cat_id]
+            gt = self._gts.get((img_id, cat_id), [])
+            dt = self._dts.get((img_id, cat_id), [])
         else:
             gt = [
                 _ann for _cat_id in self.params.cat_ids
@@ -183,11 +313,30 @@ class LVISEval:
         gt = [g[ann_type] for g in gt]
         dt = [d[ann_type] for d in dt]
 
+        if len(dt) == 0 or len(gt) == 0:
+            return []
+        sparse = self._sparse_ious(len(dt), len(gt))
+        if ann_type == "segmentation":
+            # only intersect the masks whose bounding boxes overlap
+            ious = mask_utils.sparseIou(dt, gt, iscrowd)
+            return ious if sparse else denseIous(ious, len(dt), len(gt))
+        if sparse:
+            # large blocks keep the overlapping pairs only
+            return bboxOverlaps(dt, gt, iscrowd)
+
         # compute iou between each dt and gt region
         # will return array of shape len(dt), len(gt)
         ious = mask_utils.iou(dt, gt, iscrowd)
         return ious
 
+    def _sparse_ious(self, num_dt, num_gt):
+        """Whether the ious of num_dt dts and num_gt gts are stored sparse,
+        as the (d, g, iou) arrays of the overlapping pairs only.
+        """
+        return (self.params.sparse_iou_min is not None
+                and min(self.params.iou_thrs) > 0
+                and num_dt * num_gt >= self.params.sparse_iou_min)
+
     def evaluate_img(self, img_id, cat_id, area_rng):
         """Perform evaluation for single category and image."""
         gt, dt = self._get_gt_dt(img_id, cat_id)
@@ -212,9 +361,10 @@ class LVISEval:
         dt = [dt[i] for i in dt_idx]
 
         # load computed ious
-        ious = (self.ious[img_id, cat_id][:, gt_idx]
-                if len(self.ious[img_id, cat_id]) > 0 else self.ious[img_id,
-                                                                     cat_id])
+        ious = self.ious[img_id, cat_id]
+        if isinstance(ious, tuple):
+            ious = denseIous(ious, len(dt), len(gt))
+        ious = ious[:, gt_idx] if len(ious) > 0 else ious
 
         num_thrs = len(self.params.iou_thrs)
         num_gt = len(gt)
@@ -265,13 +415,13 @@ class LVISEval:
 
         # For LVIS we will ignore any unmatched detection if that category was
         # not exhaustively annotated in gt.
-        dt_ig_mask = [
-            d["area"] < area_rng[0] or d["area"] > area_rng[1]
-            or d["category_id"] in self.img_nel[d["image_id"]] for d in dt
-        ]
-        dt_ig_mask = np.array(dt_ig_mask).reshape((1, num_dt))  # 1 X num_dt
-        dt_ig_mask = np.repeat(dt_ig_mask, num_thrs, 0)  # num_thrs X num_dt
-        # Based on dt_ig_mask ignore any unmatched detection by updating dt_ig
+        img_nel = self.img_nel[img_id]
+        dt_area = np.array([d["area"] for d in dt], dtype=np.float64)
+        dt_ig_mask = np.array([d["category_id"] in img_nel for d in dt],
+                              dtype=bool)
+        dt_ig_mask |= (dt_area < area_rng[0]) | (dt_area > area_rng[1])
+        # Based on dt_ig_mask (broadcast over the thresholds) ignore any
+        # unmatched detection by updating dt_ig
         dt_ig = np.logical_or(dt_ig, np.logical_and(dt_m == 0, dt_ig_mask))
         # store results for given image and category
         return {
@@ -288,6 +438,74 @@ class LVISEval:
             "dt_ious": dt_iou,
         }
 
+    def evaluate_img_areas(self, img_id, cat_id, area_rngs):
+        """Perform evaluation for single category and image on all area
+        ranges at once. The dt sort, the ious and the match pass are shared,
+        only the area dependent ignore flags differ between the results,
+        which are those of evaluate_img for each area range.
+        """
+        gt, dt = self._get_gt_dt(img_id, cat_id)
+
+        if len(gt) == 0 and len(dt) == 0:
+            return [None] * len(area_rngs)
+
+        # Sort dt highest score first, as compute_iou does
+        dt_idx = np.argsort([-d["score"] for d in dt], kind="mergesort")
+        dt = [dt[i] for i in dt_idx]
+
+        area_rngs_arr = np.array(area_rngs, dtype=np.float64).reshape((-1, 2))
+        lo, hi = area_rngs_arr[:, 0:1], area_rngs_arr[:, 1:2]
+        gt_area = np.array([g["area"] for g in gt], dtype=np.float64)
+        gt_ig = np.array([g["ignore"] for g in gt], dtype=bool)
+        gt_ig = (gt_ig | (gt_area < lo) | (gt_area > hi)).astype(int)
+        gt_ids = np.array([g["id"] for g in gt], dtype=np.int64)
+        dt_ids = np.array([d["id"] for d in dt], dtype=np.int64)
+        dt_m, gt_m, dt_ig, dt_iou = greedyMatch(self.ious[img_id, cat_id],
+                                                self.params.iou_thrs, gt_ig,
+                                                np.zeros(len(gt)), dt_ids,
+                                                gt_ids)
+
+        # For LVIS we will ignore any unmatched detection if that category was
+        # not exhaustively annotated in gt.
+        img_nel = self.img_nel[img_id]
+        dt_area = np.array([d["area"] for d in dt], dtype=np.float64)
+        dt_ig_mask = np.array([d["category_id"] in img_nel for d in dt],
+                              dtype=bool)
+        dt_ig_mask = dt_ig_mask | (dt_area < lo) | (dt_area > hi)
+        dt_ids = dt_ids.tolist()
+        dt_scores = [d["score"] for d in dt]
+        results = []
+        for area_idx, area_rng in enumerate(area_rngs):
+            # report gt ignore last as evaluate_img does
+            gt_idx = np.argsort(gt_ig[area_idx], kind="mergesort")
+            results.append({
+                "image_id":
+                img_id,
+                "category_id":
+                cat_id,
+                "area_rng":
+                area_rng,
+                "dt_ids":
+                dt_ids,
+                "gt_ids":
+                gt_ids[gt_idx].tolist(),
+                "dt_matches":
+                dt_m[area_idx],
+                "gt_matches":
+                gt_m[area_idx][:, gt_idx],
+                "dt_scores":
+                dt_scores,
+                "gt_ignore":
+                gt_ig[area_idx][gt_idx],
+                "dt_ignore":
+                np.logical_or(
+                    dt_ig[area_idx],
+                    np.logical_and(dt_m[area_idx] == 0, dt_ig_mask[area_idx])),
+                "dt_ious":
+                dt_iou[area_idx],
+            })
+        return results
+
     def accumulate(self):
         """Accumulate per image evaluation results and store the result in
         self.eval.
@@ -306,7 +524,6 @@ class LVISEval:
         num_recalls = len(self.params.rec_thrs)
         num_cats = len(cat_ids)
         num_area_rngs = len(self.params.area_rng)
-        num_imgs = len(self.params.img_ids)
 
         # -1 for absent categories
         precision = -np.ones((num_thrs, num_recalls, num_cats, num_area_rngs))
@@ -325,36 +542,30 @@ class LVISEval:
             for area_idx in range(num_area_rngs):
                 dt_pointers[cat_idx][area_idx] = {}
 
+        eval_imgs = self.pack_eval_imgs()
+
         # Per category evaluation
         for cat_idx in range(num_cats):
-            Nk = cat_idx * num_area_rngs * num_imgs
             for area_idx in range(num_area_rngs):
-                Na = area_idx * num_imgs
-                E = [
-                    self.eval_imgs[Nk + Na + img_idx]
-                    for img_idx in range(num_imgs)
-                ]
-                # Remove elements which are None
-                E = [e for e in E if e is not None]
-                if len(E) == 0:
+                # Gather the results of all images, skipping empty ones
+                dt_inds, gt_inds, num_e = eval_imgs.gatherSetting(
+                    cat_idx, area_idx, None)
+                if num_e == 0:
                     continue
 
                 # Append all scores: shape (N,)
-                dt_scores = np.concatenate([e["dt_scores"] for e in E], axis=0)
-                dt_ids = np.concatenate([e["dt_ids"] for e in E], axis=0)
+                dt_scores = eval_imgs.dt_scores[dt_inds]
+                dt_ids = eval_imgs.dt_ids[dt_inds]
 
                 dt_idx = np.argsort(-dt_scores, kind="mergesort")
                 dt_scores = dt_scores[dt_idx]
                 dt_ids = dt_ids[dt_idx]
 
-                dt_m = np.concatenate([e["dt_matches"] for e in E],
-                                      axis=1)[:, dt_idx]
-                dt_ig = np.concatenate([e["dt_ignore"] for e in E],
-                                       axis=1)[:, dt_idx]
-                dt_iou = np.concatenate([e["dt_ious"] for e in E],
-                                        axis=1)[:, dt_idx]
+                dt_m = eval_imgs.dt_matches[:, dt_inds[dt_idx]]
+                dt_ig = eval_imgs.dt_ignore[:, dt_inds[dt_idx]]
+                dt_iou = eval_imgs.dt_ious[:, dt_inds[dt_idx]]
 
-                gt_ig = np.concatenate([e["gt_ignore"] for e in E])
+                gt_ig = eval_imgs.gt_ignore[gt_inds]
                 # num gt anns to consider
                 num_gt = np.count_nonzero(gt_ig == 0)
 
@@ -609,6 +820,69 @@ class LVISEval:
         return self.results
 
 
+def _pair_keys(img_ids, cat_ids):
+    """Encode (img_id, cat_id) pairs as int64 keys for vectorized lookups."""
+    img_ids = np.asarray(img_ids, dtype=np.int64)
+    cat_ids = np.asarray(cat_ids, dtype=np.int64)
+    return (img_ids << 32) | cat_ids
+
+
+def _img_cat_keys(img_cats):
+    """Sorted keys (see _pair_keys) of the pairs of a dict mapping image ids
+    to sets of category ids.
+    """
+    img_ids = [img_id for img_id, cats in img_cats.items() for _ in cats]
+    cat_ids = [cat_id for cats in img_cats.values() for cat_id in cats]
+    return np.unique(_pair_keys(img_ids, cat_ids))
+
+
+def _evaluate_shard(lvis_eval):
+    """Worker for LVISEval._evaluate_parallel.
+    Args:
+        lvis_eval (LVISEval): evaluator of the images of a shard
+    Returns:
+        ious and eval_imgs of the shard
+    """
+    params = lvis_eval.params
+    cat_ids = params.cat_ids if params.use_cats else [-1]
+    lvis_eval.eval_imgs = LVISEvalImgs(params.img_ids, cat_ids,
+                                       params.area_rng, params.max_dets,
+                                       len(params.iou_thrs))
+    lvis_eval._evaluate_pairs()
+    return lvis_eval.ious, lvis_eval.eval_imgs
+
+
+class LVISEvalImgs(EvalImgs):
+    """Columnar store for the per image results of LVISEval.evaluate(),
+    indexed like the list of evaluate_img dicts (see pycocotools EvalImgs).
+    """
+    dtFields = ("dt_ids", "dt_scores")
+    dtThrFields = ("dt_matches", "dt_ignore", "dt_ious")
+    gtFields = ("gt_ids", "gt_ignore")
+    gtThrFields = ("gt_matches", )
+    dtypes = {
+        "dt_ids": np.int64,
+        "dt_scores": np.float64,
+        "dt_matches": np.float64,
+        "dt_ignore": bool,
+        "dt_ious": np.float64,
+        "gt_ids": np.int64,
+        "gt_ignore": np.uint8,
+        "gt_matches": np.float64,
+    }
+    viewFields = ("dt_ids", "gt_ids", "dt_matches", "gt_matches",
+                  "dt_scores", "gt_ignore", "dt_ignore", "dt_ious")
+    listFields = ("dt_ids", "gt_ids", "dt_scores")
+
+    def _header(self, index):
+        num_area_rngs, num_imgs = len(self.areaRng), len(self.imgIds)
+        return {
+            "image_id": self.imgIds[index % num_imgs],
+            "category_id": self.catIds[index // (num_area_rngs * num_imgs)],
+            "area_rng": self.areaRng[index // num_imgs % num_area_rngs],
+        }
+
+
 class Params:
     def __init__(self, iou_type):
         """Params for LVIS evaluation API."""
@@ -640,3 +914,9 @@ class Params:
         # f: Frequent: >= 100
         self.img_count_lbl = ["r", "c", "f"]
         self.iou_type = iou_type
+        # "vectorized" matches all iou_thrs and area ranges at once, "loop"
+        # (evaluate_img) is the reference; both give identical matches
+        self.matcher = "vectorized"
+        # ious of blocks with at least this many pairs are kept sparse
+        # (see compute_iou), None disables
+        self.sparse_iou_min = 4096
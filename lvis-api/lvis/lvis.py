@@ -12,19 +12,31 @@ import os
 from collections import defaultdict
 from urllib.request import urlretrieve
 
+import pycocotools.cache as cache_utils
 import pycocotools.mask as mask_utils
+import pycocotools.results as result_utils
 
 
 class LVIS:
-    def __init__(self, annotation_path):
+    def __init__(self, annotation_path, cache=False):
         """Class for reading and visualizing annotations.
         Args:
             annotation_path (str): location of annotation file
+            cache (bool): load the annotations from a binary cache next to
+            the annotation file, which is written on first use. It skips
+            the json parsing, the annotations still take the memory of
+            dicts (see pycocotools.cache)
         """
         self.logger = logging.getLogger(__name__)
         self.logger.info("Loading annotations.")
 
-        self.dataset = self._load_json(annotation_path)
+        self.dataset = None
+        if cache:
+            self.dataset = cache_utils.loadCache(annotation_path)
+        if self.dataset is None:
+            self.dataset = self._load_json(annotation_path)
+            if cache:
+                cache_utils.saveCache(annotation_path, self.dataset)
 
         assert (isinstance(
             self.dataset,
@@ -169,6 +181,7 @@ class LVIS:
 
     def ann_to_rle(self, ann):
         """Convert annotation which can be polygons, uncompressed RLE to RLE.
+        Results without segmentation are converted from their bbox.
         Args:
             ann (dict) : annotation object
 
@@ -177,7 +190,7 @@ class LVIS:
         """
         img_data = self.imgs[ann["image_id"]]
         h, w = img_data["height"], img_data["width"]
-        segm = ann["segmentation"]
+        segm = result_utils.annSegmentation(ann)
         if isinstance(segm, list):
             # polygon -- a single object might consist of multiple parts
             # we merge all parts into one mask rle code
@@ -188,9 +201,26 @@ class LVIS:
             rle = mask_utils.frPyObjects(segm, h, w)
         else:
             # rle
-            rle = ann["segmentation"]
+            rle = segm
         return rle
 
+    def anns_to_rles(self, anns, num_workers=1):
+        """Convert many annotations to RLE as ann_to_rle does, with the
+        annotations of each image size converted together in a pool of
+        processes (see pycocotools.mask.frSegmentations).
+        Args:
+            anns (list[dict]) : annotation objects
+            num_workers (int) : number of processes
+
+        Returns:
+            rles (list[rle]) : rles in the order of anns
+        """
+        sizes = [(self.imgs[ann["image_id"]]["height"],
+                  self.imgs[ann["image_id"]]["width"]) for ann in anns]
+        return mask_utils.frSegmentations(
+            [result_utils.annSegmentation(ann) for ann in anns], sizes,
+            num_workers)
+
     def ann_to_mask(self, ann):
         """Convert annotation which can be polygons, uncompressed RLE, or RLE
         to binary mask.
@@ -1,6 +1,5 @@
 import logging
 from collections import defaultdict
-from copy import deepcopy
 
 from lvis.lvis import LVIS
 
@@ -18,7 +17,11 @@ class LVISResults(LVIS):
             value of max_dets for LVIS is 300.
         """
         if isinstance(lvis_gt, LVIS):
-            self.dataset = deepcopy(lvis_gt.dataset)
+            # the gt tables are shared, only the annotations are replaced
+            self.dataset = {
+                k: v
+                for k, v in lvis_gt.dataset.items() if k != "annotations"
+            }
         elif isinstance(lvis_gt, str):
             self.dataset = self._load_json(lvis_gt)
         else:
@@ -42,14 +45,10 @@ class LVISResults(LVIS):
             result_anns = self.limit_dets_per_image(result_anns, max_dets)
 
         if "bbox" in result_anns[0]:
+            # the polygons of the bboxes are only made for segm evaluation
+            # or visualization (see pycocotools.results.annSegmentation)
             for id, ann in enumerate(result_anns):
                 x1, y1, w, h = ann["bbox"]
-                x2 = x1 + w
-                y2 = y1 + h
-
-                if "segmentation" not in ann:
-                    ann["segmentation"] = [[x1, y1, x1, y2, x2, y2, x2, y1]]
-
                 ann["area"] = w * h
                 ann["id"] = id + 1
 
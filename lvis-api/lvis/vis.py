@@ -9,6 +9,8 @@ from lvis.lvis import LVIS
 from lvis.results import LVISResults
 from matplotlib.patches import Polygon
 
+import pycocotools.results as result_utils
+
 
 class LVISVis:
     def __init__(self, lvis_gt, lvis_dt=None, img_dir=None, dpi=75):
@@ -169,7 +171,7 @@ class LVISVis:
         boxes, segms, classes, scores = [], [], [], []
         for ann in anns:
             boxes.append(ann["bbox"])
-            segms.append(ann["segmentation"])
+            segms.append(result_utils.annSegmentation(ann))
             classes.append(ann["category_id"])
             scores.append(ann["score"])
 
@@ -0,0 +1,277 @@
+import gc
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Binary cache of annotation files for the COCO and LVIS loaders.
+#
+# Parsing a large annotation file with json.load dominates the start of
+# an evaluation job. saveCache writes the dataset of an annotation file
+# next to it, into the directory <name>.cache, with the annotations laid
+# out column-wise: one .npy file per field, which loadCache memory-maps
+# and turns back into the dataset dict much faster than the json parser.
+# The cache only saves the parsing: loadCache builds the dataset dict of
+# ann dicts json.load would, so the dataset takes as much memory as one
+# loaded from json, and the columns are dropped once it is built.
+# The cache belongs to the version of the annotation file it was written
+# for (its size and mtime) and is ignored once the file changes.
+#
+# Several processes may open the same file at once (such as the ranks of
+# a distributed job): each version is written to a temporary directory
+# and renamed into <name>.cache/<size>-<mtime> in one step, the first
+# process to finish wins and the others drop their copy. A version is
+# never removed while it is current, so readers never see it change; the
+# directories of older versions are removed by the next save. Failing to
+# write the cache (e.g. in a read-only directory) or to read any of it
+# only means there is no cache.
+#
+# The following API functions are defined:
+#  loadCache - Load the dataset of an annotation file from its cache.
+#  saveCache - Save the dataset of an annotation file to its cache.
+#  fileStamp - Identify the version of a file.
+#
+# Usage:
+#  dataset = loadCache( annFile )
+#  saveCache( annFile, dataset )
+#
+# Layout of a version of the cache (n anns, of which the fields id,
+# image_id, category_id, area, iscrowd, bbox and segmentation are stored
+# as columns if every ann has them in a supported form):
+#  meta.json        - stamp, column fields, all other dataset keys and the
+#                     remaining ann fields (if any)
+#  <field>.npy      - [n] int64 or float64 numbers (or [nx4] for bbox)
+#  segmKind.npy     - [n] 0 polygons, 1 RLE, 2 uncompressed RLE
+#  polyCount.npy    - [n] number of polygons of each ann
+#  polyLen.npy      - [P] number of coordinates of each polygon
+#  polyXy.npy       - concatenated polygon coordinates
+#  rleSize.npy      - [nx2] size of each RLE
+#  rleLen.npy       - [n] length of the counts of each RLE
+#  rleChars.npy     - concatenated counts strings of the RLEs
+#  rleInts.npy      - concatenated counts of the uncompressed RLEs
+# Numbers read back as float if their column mixes ints and floats.
+
+_numberFields = ['id', 'image_id', 'category_id', 'area', 'iscrowd']
+
+
+def fileStamp(path):
+    # identifies the version of a file
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def loadCache(annFile):
+    '''
+    Load the dataset of annFile from its cache, with every ann a dict as
+    json.load gives it (see above).
+    :param annFile (str): annotation file
+    :return: dataset (dict), or None if there is no cache of the current
+             version of annFile
+    '''
+    try:
+        stamp = fileStamp(annFile)
+        versionDir = _versionDir(annFile, stamp)
+        with open(os.path.join(versionDir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta['source'] != stamp:
+        return None
+
+    def _load(name):
+        return np.load(os.path.join(versionDir, name + '.npy'), mmap_mode='r')
+
+    # the collector would run over and over while the anns are built
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        fields = meta['fields']
+        columns = [
+            _unpackSegms(_load) if f == 'segmentation' else _load(f).tolist()
+            for f in fields
+        ]
+        anns = [dict(zip(fields, values)) for values in zip(*columns)]
+    except (OSError, ValueError):
+        # a column is missing or cut short
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+    if meta['extra'] is not None:
+        for ann, extra in zip(anns, meta['extra']):
+            ann.update(extra)
+    dataset = meta['dataset']
+    if meta['hasAnns']:
+        dataset['annotations'] = anns
+    return dataset
+
+
+def saveCache(annFile, dataset):
+    '''
+    Save the dataset loaded from annFile to its cache, unless the cache
+    cannot be written or another process saved the same version first.
+    :param annFile (str): annotation file
+    :param dataset (dict): dataset loaded from annFile
+    :return: None
+    '''
+    anns = dataset.get('annotations', [])
+    columns = {}
+    for f in _numberFields:
+        c = _numbers([ann.get(f) for ann in anns])
+        if c is not None:
+            columns[f] = c
+    bboxes = [ann.get('bbox') for ann in anns]
+    if all(isinstance(bb, list) and len(bb) == 4 for bb in bboxes):
+        c = _numbers([x for bb in bboxes for x in bb])
+        if c is not None:
+            columns['bbox'] = c.reshape((len(anns), 4))
+    segms = _packSegms([ann.get('segmentation') for ann in anns])
+    if segms is not None:
+        columns.update(segms)
+    # column fields in the order of the first ann, the others stay json
+    fields = [
+        f for f in (anns[0] if anns else [])
+        if f in columns or (f == 'segmentation' and segms is not None)
+    ]
+    extra = [{k: v for k, v in ann.items() if k not in fields} for ann in anns]
+    stamp = fileStamp(annFile)
+    meta = {
+        'source': stamp,
+        'fields': fields,
+        'hasAnns': 'annotations' in dataset,
+        'dataset': {k: v
+                    for k, v in dataset.items() if k != 'annotations'},
+        'extra': extra if any(extra) else None,
+    }
+    # write a new directory and rename it into place, so readers never see
+    # a version before it is complete
+    cacheDir = _cacheDir(annFile)
+    versionDir = _versionDir(annFile, stamp)
+    tmpDir = None
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        tmpDir = tempfile.mkdtemp(prefix='.', suffix='.tmp', dir=cacheDir)
+        for name, c in columns.items():
+            np.save(os.path.join(tmpDir, name + '.npy'), c)
+        with open(os.path.join(tmpDir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        # fails if another process renamed its copy into place first
+        os.rename(tmpDir, versionDir)
+        tmpDir = None
+    except OSError:
+        return
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+    # drop older versions, but not the temporary directories of others
+    for name in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, name)
+        if not name.startswith('.') and path != versionDir:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _cacheDir(annFile):
+    return os.path.splitext(annFile)[0] + '.cache'
+
+
+def _versionDir(annFile, stamp):
+    # directory of the cache of the version of annFile with this stamp
+    return os.path.join(_cacheDir(annFile), '{}-{!r}'.format(*stamp))
+
+
+def _numbers(values):
+    # int64 or float64 array of json numbers, None for anything else
+    if all(type(v) is int for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(type(v) in (int, float) for v in values):
+        return np.array(values, dtype=np.float64)
+    return None
+
+
+def _packSegms(segms):
+    '''
+    Pack polygons and RLEs into the columns of the cache.
+    :return: dict of columns, None if a segmentation is not supported
+    '''
+    kind = np.zeros(len(segms), dtype=np.uint8)
+    polyCount = np.zeros(len(segms), dtype=np.int64)
+    rleSize = np.zeros((len(segms), 2), dtype=np.int64)
+    rleLen = np.zeros(len(segms), dtype=np.int64)
+    polyLen, polyXy, rleChars, rleInts = [], [], [], []
+    for i, segm in enumerate(segms):
+        if isinstance(segm, list):
+            if not all(isinstance(poly, list) for poly in segm):
+                return None
+            polyCount[i] = len(segm)
+            polyLen += [len(poly) for poly in segm]
+            polyXy += [x for poly in segm for x in poly]
+        elif isinstance(segm, dict) and sorted(segm) == ['counts', 'size']:
+            rleSize[i] = segm['size']
+            rleLen[i] = len(segm['counts'])
+            if isinstance(segm['counts'], str):
+                kind[i] = 1
+                try:
+                    rleChars.append(segm['counts'].encode('ascii'))
+                except UnicodeEncodeError:
+                    return None
+            elif (isinstance(segm['counts'], list)
+                  and all(type(c) is int for c in segm['counts'])):
+                kind[i] = 2
+                rleInts += segm['counts']
+            else:
+                return None
+        else:
+            return None
+    polyXy = _numbers(polyXy)
+    if polyXy is None:
+        return None
+    return {
+        'segmKind': kind,
+        'polyCount': polyCount,
+        'polyLen': np.array(polyLen, dtype=np.int64),
+        'polyXy': polyXy,
+        'rleSize': rleSize,
+        'rleLen': rleLen,
+        'rleChars': np.frombuffer(b''.join(rleChars), dtype=np.uint8),
+        'rleInts': np.array(rleInts, dtype=np.int64),
+    }
+
+
+def _unpackSegms(load):
+    '''
+    Rebuild the segmentations packed by _packSegms.
+    :param load: function loading a column by name
+    :return: list of segmentations
+    '''
+    kind = load('segmKind')
+    polyEnd = np.cumsum(load('polyLen')).tolist()
+    polyXy = load('polyXy').tolist()
+    polys = [polyXy[s:e] for s, e in zip([0] + polyEnd, polyEnd)]
+    polyCount = load('polyCount').tolist()
+    annEnd = np.cumsum(polyCount).tolist()
+    rleSize = load('rleSize').tolist()
+    rleLen = load('rleLen')
+    charEnd = np.cumsum(rleLen * (kind == 1)).tolist()
+    intEnd = np.cumsum(rleLen * (kind == 2)).tolist()
+    rleLen = rleLen.tolist()
+    rleChars = load('rleChars').tobytes().decode('ascii')
+    rleInts = load('rleInts').tolist()
+    segms = []
+    for i, k in enumerate(kind.tolist()):
+        if k == 0:
+            segms.append(polys[annEnd[i] - polyCount[i]:annEnd[i]])
+        elif k == 1:
+            e = charEnd[i]
+            segms.append({
+                'size': rleSize[i],
+                'counts': rleChars[e - rleLen[i]:e]
+            })
+        else:
+            e = intEnd[i]
+            segms.append({
+                'size': rleSize[i],
+                'counts': rleInts[e - rleLen[i]:e]
+            })
+    return segms
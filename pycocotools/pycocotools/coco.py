@@ -29,6 +29,9 @@ __version__ = '2.0'
 #  loadCats   - Load cats with the specified ids.
 #  loadImgs   - Load imgs with the specified ids.
 #  annToMask  - Convert segmentation in an annotation to binary mask.
+#  annsToRLEs - Convert segmentations of many anns to RLE in parallel.
+#  loadRLEs   - Load RLE masks of anns, cached by ann id.
+#  saveRLEs   - Save RLE masks of all anns next to the annotation file.
 #  showAnns   - Display the specified annotations.
 #  loadRes    - Load algorithm results and create API for accessing them.
 #  download   - Download COCO images from mscoco.org server.
@@ -45,8 +48,6 @@ __version__ = '2.0'
 # Code written by Piotr Dollar and Tsung-Yi Lin, 2014.
 # Licensed under the Simplified BSD License [see bsd.txt]
 
-import copy
-import itertools
 import json
 import os
 import sys
@@ -59,6 +60,10 @@ from matplotlib.collections import PatchCollection
 from matplotlib.patches import Polygon
 
 from . import mask as maskUtils
+from .cache import fileStamp, loadCache, saveCache
+from .kernels import segmentIndex
+from .results import (annSegmentation, bboxColumns, finalizeColumns,
+                      finalizeResults, loadResults, resultType)
 
 PYTHON_VERSION = sys.version_info[0]
 if PYTHON_VERSION == 2:
@@ -71,30 +76,74 @@ def _isArrayLike(obj):
     return hasattr(obj, '__iter__') and hasattr(obj, '__len__')
 
 
+def _numpyColumns(data):
+    # columns of the results in a numpy array [Nx7] with the fields loadRes
+    # adds to bbox results
+    assert (isinstance(data, np.ndarray))
+    print(data.shape)
+    assert (data.shape[1] == 7)
+    return finalizeColumns({
+        'image_id': data[:, 0].astype(np.int64),
+        'bbox': data[:, 1:5].astype(np.float64),
+        'score': data[:, 5].astype(np.float64),
+        'category_id': data[:, 6].astype(np.int64),
+    })
+
+
+def _numpyAnns(columns):
+    # anns of the columns of _numpyColumns, as loadNumpyAnnotations returns
+    return [{
+        'image_id': imgId,
+        'bbox': bb,
+        'score': score,
+        'category_id': catId,
+    } for imgId, bb, score, catId in
+            zip(columns['image_id'].tolist(), columns['bbox'].tolist(),
+                columns['score'].tolist(), columns['category_id'].tolist())]
+
+
 class COCO:
-    def __init__(self, annotation_file=None):
+    def __init__(self, annotation_file=None, cache=False):
         """
         Constructor of Microsoft COCO helper class for reading
         and visualizing annotations.
         :param annotation_file (str): location of annotation file
         :param image_folder (str): location to the folder that hosts images.
+        :param cache (bool): load the annotations from a binary cache next
+                             to the annotation file, written on first use,
+                             which skips the json parsing but not the
+                             memory of the anns (see cache.py)
         :return:
         """
         # load dataset
         self.dataset, self.anns, self.cats, self.imgs = dict(), dict(), dict(
         ), dict()
         self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
+        self.rles = {}  # RLE masks of anns by id (see loadRLEs)
+        self.annColumns = None  # columns of bbox results (see loadRes)
+        self.annFile = annotation_file
+        # an empty index until createIndex, so queries find no anns
+        self._index = self._createArrayIndex({
+            f: []
+            for f in ['id', 'image_id', 'category_id', 'area', 'iscrowd']
+        })
         if annotation_file is not None:
             print('loading annotations into memory...')
             tic = time.time()
-            dataset = json.load(open(annotation_file, 'r'))
-            assert isinstance(
-                dataset,
-                dict), 'annotation file format {} not supported'.format(
-                    type(dataset))
+            dataset = loadCache(annotation_file) if cache else None
+            if dataset is None:
+                dataset = json.load(open(annotation_file, 'r'))
+                assert isinstance(
+                    dataset,
+                    dict), 'annotation file format {} not supported'.format(
+                        type(dataset))
+                if cache:
+                    saveCache(annotation_file, dataset)
             print('Done (t={:0.2f}s)'.format(time.time() - tic))
             self.dataset = dataset
             self.createIndex()
+            # read RLE masks saved by saveRLEs on first use
+            self.rles = None
 
     def createIndex(self):
         # create index
@@ -121,11 +170,65 @@ class COCO:
         print('index created!')
 
         # create class members
+        self.imgs = imgs
+        self.cats = cats
+        self.rles = {}
         self.anns = anns
         self.imgToAnns = imgToAnns
         self.catToImgs = catToImgs
-        self.imgs = imgs
-        self.cats = cats
+        annList = self.dataset.get('annotations', [])
+        columns = {
+            f: [ann.get(f, np.nan) for ann in annList]
+            for f in ['area', 'iscrowd']
+        }
+        columns['id'] = [ann['id'] for ann in annList]
+        columns['image_id'] = [ann['image_id'] for ann in annList]
+        # anns without a category are ranked together
+        columns['category_id'] = [ann.get('category_id') for ann in annList]
+        self._index = self._createArrayIndex(columns)
+
+    def _createArrayIndex(self, columns):
+        '''
+        Index the anns in arrays for getAnnIds and getImgIds: the filtered
+        fields as columns in dataset order, with image and category ids
+        replaced by their rank, the anns of each image as CSR offsets into
+        an image sorted order and the images of each category likewise.
+        :param columns: dict of the id, image_id, category_id, area and
+                        iscrowd of each ann (list or array)
+        :return: dict of index arrays and the id <-> rank maps
+        '''
+        ids, imgIds, catIds = [
+            c.tolist() if isinstance(c, np.ndarray) else c for c in
+            [columns['id'], columns['image_id'], columns['category_id']]
+        ]
+        imgRank = {imgId: i for i, imgId in enumerate(self.imgs)}
+        for imgId in dict.fromkeys(imgIds):
+            imgRank.setdefault(imgId, len(imgRank))
+        catRank = {catId: i for i, catId in enumerate(dict.fromkeys(catIds))}
+        index = {'imgRank': imgRank, 'catRank': catRank}
+        index['imgIds'] = list(imgRank)
+        index['ids'] = ids
+        img = np.fromiter(map(imgRank.__getitem__, imgIds),
+                          dtype=np.int64,
+                          count=len(imgIds))
+        cat = np.fromiter(map(catRank.__getitem__, catIds),
+                          dtype=np.int64,
+                          count=len(catIds))
+        index['img'], index['cat'] = img, cat
+        for f in ['area', 'iscrowd']:
+            index[f] = np.asarray(columns[f], dtype=np.float64)
+        I, K = max(len(imgRank), 1), len(catRank)
+        index['imgOrder'] = np.argsort(img, kind='mergesort')
+        index['imgPtr'] = np.concatenate(
+            ([0], np.cumsum(np.bincount(img, minlength=len(imgRank)))))
+        # unique (category, image) pairs, catToImgs needs the categories
+        if 'categories' in self.dataset:
+            pairs = np.unique(cat * I + img)
+        else:
+            pairs = np.zeros(0, dtype=np.int64)
+        index['catImgs'] = pairs % I
+        index['catPtr'] = np.searchsorted(pairs // I, np.arange(K + 1))
+        return index
 
     def info(self):
         """
@@ -149,30 +252,33 @@ class COCO:
         """
         imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
         catIds = catIds if _isArrayLike(catIds) else [catIds]
+        index = self._index
 
-        if len(imgIds) == len(catIds) == len(areaRng) == 0:
-            anns = self.dataset['annotations']
+        if len(imgIds) == 0:
+            inds = np.arange(len(index['ids']))
         else:
-            if not len(imgIds) == 0:
-                lists = [
-                    self.imgToAnns[imgId] for imgId in imgIds
-                    if imgId in self.imgToAnns
-                ]
-                anns = list(itertools.chain.from_iterable(lists))
-            else:
-                anns = self.dataset['annotations']
-            anns = anns if len(catIds) == 0 else [
-                ann for ann in anns if ann['category_id'] in catIds
-            ]
-            anns = anns if len(areaRng) == 0 else [
-                ann for ann in anns
-                if ann['area'] > areaRng[0] and ann['area'] < areaRng[1]
-            ]
+            # the anns of each image, in the order of imgIds
+            ranks = np.array([
+                index['imgRank'][imgId]
+                for imgId in imgIds if imgId in index['imgRank']
+            ],
+                             dtype=np.int64)
+            starts = index['imgPtr'][ranks]
+            inds = index['imgOrder'][segmentIndex(
+                starts, index['imgPtr'][ranks + 1] - starts)]
+        if not len(catIds) == 0:
+            keep = np.zeros(len(index['catRank']), dtype=bool)
+            keep[[
+                index['catRank'][catId] for catId in catIds
+                if catId in index['catRank']
+            ]] = True
+            inds = inds[keep[index['cat'][inds]]]
+        if not len(areaRng) == 0:
+            area = index['area'][inds]
+            inds = inds[(area > areaRng[0]) & (area < areaRng[1])]
         if iscrowd is not None:
-            ids = [ann['id'] for ann in anns if ann['iscrowd'] == iscrowd]
-        else:
-            ids = [ann['id'] for ann in anns]
-        return ids
+            inds = inds[index['iscrowd'][inds] == iscrowd]
+        return [index['ids'][i] for i in inds.tolist()]
 
     def getCatIds(self, catNms=[], supNms=[], catIds=[]):
         """
@@ -212,16 +318,25 @@ class COCO:
         imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
         catIds = catIds if _isArrayLike(catIds) else [catIds]
 
-        if len(imgIds) == len(catIds) == 0:
-            ids = self.imgs.keys()
-        else:
-            ids = set(imgIds)
-            for i, catId in enumerate(catIds):
-                if i == 0 and len(ids) == 0:
-                    ids = set(self.catToImgs[catId])
-                else:
-                    ids &= set(self.catToImgs[catId])
-        return list(ids)
+        index = self._index
+
+        if len(catIds) == 0:
+            ids = self.imgs.keys() if len(imgIds) == 0 else set(imgIds)
+            return list(ids)
+        # images with all given cats, among imgIds if given
+        keep = np.zeros(len(index['imgIds']), dtype=bool)
+        keep[[
+            index['imgRank'][imgId] for imgId in imgIds
+            if imgId in index['imgRank']
+        ]] = True
+        for i, catId in enumerate(catIds):
+            k = index['catRank'].get(catId, -1)
+            has = np.zeros(len(keep), dtype=bool)
+            if k >= 0:
+                s, e = index['catPtr'][k], index['catPtr'][k + 1]
+                has[index['catImgs'][s:e]] = True
+            keep = has if i == 0 and len(imgIds) == 0 else keep & has
+        return [index['imgIds'][i] for i in np.flatnonzero(keep).tolist()]
 
     def loadAnns(self, ids=[]):
         """
@@ -234,6 +349,62 @@ class COCO:
         elif isinstance(ids, int):
             return [self.anns[ids]]
 
+    def loadRLEs(self, ids=[], num_workers=1):
+        """
+        Load RLE masks of the anns with the specified ids. Each ann is
+        converted once (see annsToRLEs) and cached by id, so polygons are
+        not rasterized again. The anns themselves are left unchanged.
+        :param ids (int array)       : integer ids specifying anns
+        :param num_workers (int)     : processes converting uncached anns
+        :return: rles (object array) : loaded RLE masks
+        """
+        if self.rles is None:
+            self.rles = self._readRLEs()
+        ids = ids if _isArrayLike(ids) else [ids]
+        missing = list(dict.fromkeys(id for id in ids if id not in self.rles))
+        self.rles.update(
+            zip(missing, self.annsToRLEs(self.loadAnns(missing), num_workers)))
+        return [self.rles[id] for id in ids]
+
+    def saveRLEs(self):
+        """
+        Save the RLE masks of all anns next to the annotation file (with
+        the extension .rle.json), so that COCO objects loading the same
+        annotation file later start with them (see loadRLEs). The saved
+        masks are ignored once the annotation file changes.
+        :return:
+        """
+        if self.annFile is None:
+            raise Exception('no annotation file to save the RLEs for')
+        ids = [id for id, ann in self.anns.items() if 'segmentation' in ann]
+        rles = [[id, rle['size'], rle['counts']]
+                for id, rle in zip(ids, self.loadRLEs(ids))]
+        for rle in rles:
+            if isinstance(rle[2], bytes):
+                rle[2] = rle[2].decode('ascii')
+        with open(self._rleFile(), 'w') as f:
+            json.dump({'source': fileStamp(self.annFile), 'rles': rles}, f)
+
+    def _rleFile(self):
+        return os.path.splitext(self.annFile)[0] + '.rle.json'
+
+    def _readRLEs(self):
+        rleFile = self._rleFile()
+        if not os.path.exists(rleFile):
+            return {}
+        with open(rleFile, 'r') as f:
+            cache = json.load(f)
+        if cache['source'] != fileStamp(self.annFile):
+            print('ignoring {}, the annotation file changed'.format(rleFile))
+            return {}
+        return {
+            id: {
+                'size': size,
+                'counts': counts.encode('ascii')
+            }
+            for id, size, counts in cache['rles']
+        }
+
     def loadCats(self, ids=[]):
         """
         Load cats with the specified ids.
@@ -264,7 +435,8 @@ class COCO:
         """
         if len(anns) == 0:
             return 0
-        if 'segmentation' in anns[0] or 'keypoints' in anns[0]:
+        if ('segmentation' in anns[0] or 'keypoints' in anns[0]
+                or 'bbox' in anns[0]):
             datasetType = 'instances'
         elif 'caption' in anns[0]:
             datasetType = 'captions'
@@ -277,10 +449,12 @@ class COCO:
             color = []
             for ann in anns:
                 c = (np.random.random((1, 3)) * 0.6 + 0.4).tolist()[0]
-                if 'segmentation' in ann:
-                    if isinstance(ann['segmentation'], list):
+                # bbox results are drawn as the polygons of their bboxes
+                if 'segmentation' in ann or 'bbox' in ann:
+                    segm = annSegmentation(ann)
+                    if isinstance(segm, list):
                         # polygon
-                        for seg in ann['segmentation']:
+                        for seg in segm:
                             poly = np.array(seg).reshape(
                                 (int(len(seg) / 2), 2))
                             polygons.append(Polygon(poly))
@@ -288,12 +462,11 @@ class COCO:
                     else:
                         # mask
                         t = self.imgs[ann['image_id']]
-                        if isinstance(ann['segmentation']['counts'], list):
-                            rle = maskUtils.frPyObjects([ann['segmentation']],
-                                                        t['height'],
+                        if isinstance(segm['counts'], list):
+                            rle = maskUtils.frPyObjects([segm], t['height'],
                                                         t['width'])
                         else:
-                            rle = [ann['segmentation']]
+                            rle = [segm]
                         m = maskUtils.decode(rle)
                         img = np.ones((m.shape[0], m.shape[1], 3))
                         if ann['iscrowd'] == 1:
@@ -363,57 +536,41 @@ class COCO:
 
         print('Loading and preparing results...')
         tic = time.time()
+        finalized, columns = False, None
         if isinstance(resFile, str):
-            anns = json.load(open(resFile))
+            # finalized while it is read, json.load only takes other layouts
+            anns = loadResults(resFile)
+            finalized = anns is not None
+            if not finalized:
+                anns = json.load(open(resFile))
         elif isinstance(resFile, np.ndarray):
-            anns = self.loadNumpyAnnotations(resFile)
+            # the columns COCOeval evaluates bboxes from and their anns
+            print('Converting ndarray to lists...')
+            columns = _numpyColumns(resFile)
+            anns = _numpyAnns(columns)
         else:
             anns = resFile
         assert isinstance(anns, list), 'results in not an array of objects'
         annsImgIds = [ann['image_id'] for ann in anns]
         assert set(annsImgIds) == (set(annsImgIds) & set(self.getImgIds())), \
             'Results do not correspond to current coco set'
-        if 'caption' in anns[0]:
+        kind = resultType(anns[0])
+        if kind == 'caption':
             imgIds = set([img['id'] for img in res.dataset['images']]) & set(
                 [ann['image_id'] for ann in anns])
             res.dataset['images'] = [
                 img for img in res.dataset['images'] if img['id'] in imgIds
             ]
-            for id, ann in enumerate(anns):
-                ann['id'] = id + 1
-        elif 'bbox' in anns[0] and not anns[0]['bbox'] == []:
-            res.dataset['categories'] = copy.deepcopy(
-                self.dataset['categories'])
-            for id, ann in enumerate(anns):
-                bb = ann['bbox']
-                x1, x2, y1, y2 = [bb[0], bb[0] + bb[2], bb[1], bb[1] + bb[3]]
-                if 'segmentation' not in ann:
-                    ann['segmentation'] = [[x1, y1, x1, y2, x2, y2, x2, y1]]
-                ann['area'] = bb[2] * bb[3]
-                ann['id'] = id + 1
-                ann['iscrowd'] = 0
-        elif 'segmentation' in anns[0]:
-            res.dataset['categories'] = copy.deepcopy(
-                self.dataset['categories'])
-            for id, ann in enumerate(anns):
-                # now only support compressed RLE format as segmentation
-                # results
-                ann['area'] = maskUtils.area(ann['segmentation'])
-                if 'bbox' not in ann:
-                    ann['bbox'] = maskUtils.toBbox(ann['segmentation'])
-                ann['id'] = id + 1
-                ann['iscrowd'] = 0
-        elif 'keypoints' in anns[0]:
-            res.dataset['categories'] = copy.deepcopy(
-                self.dataset['categories'])
-            for id, ann in enumerate(anns):
-                s = ann['keypoints']
-                x = s[0::3]
-                y = s[1::3]
-                x0, x1, y0, y1 = np.min(x), np.max(x), np.min(y), np.max(y)
-                ann['area'] = (x1 - x0) * (y1 - y0)
-                ann['id'] = id + 1
-                ann['bbox'] = [x0, y0, x1 - x0, y1 - y0]
+        elif kind is not None:
+            # the images and categories are shared with the gt, not copied
+            res.dataset['categories'] = [
+                cat for cat in self.dataset['categories']
+            ]
+        if not finalized:
+            finalizeResults(anns, kind)
+        if kind == 'bbox':
+            # COCOeval evaluates bboxes from these columns, next to the anns
+            res.annColumns = bboxColumns(anns) if columns is None else columns
         print('DONE (t={:0.2f}s)'.format(time.time() - tic))
 
         res.dataset['annotations'] = anns
@@ -454,21 +611,7 @@ class COCO:
         :return: annotations (python nested list)
         """
         print('Converting ndarray to lists...')
-        assert (isinstance(data, np.ndarray))
-        print(data.shape)
-        assert (data.shape[1] == 7)
-        N = data.shape[0]
-        ann = []
-        for i in range(N):
-            if i % 1000000 == 0:
-                print('{}/{}'.format(i, N))
-            ann += [{
-                'image_id': int(data[i, 0]),
-                'bbox': [data[i, 1], data[i, 2], data[i, 3], data[i, 4]],
-                'score': data[i, 5],
-                'category_id': int(data[i, 6]),
-            }]
-        return ann
+        return _numpyAnns(_numpyColumns(data))
 
     def annToRLE(self, ann):
         """
@@ -477,7 +620,7 @@ class COCO:
         """
         t = self.imgs[ann['image_id']]
         h, w = t['height'], t['width']
-        segm = ann['segmentation']
+        segm = annSegmentation(ann)
         if isinstance(segm, list):
             # polygon -- a single object might consist of multiple parts
             # we merge all parts into one mask rle code
@@ -488,9 +631,20 @@ class COCO:
             rle = maskUtils.frPyObjects(segm, h, w)
         else:
             # rle
-            rle = ann['segmentation']
+            rle = segm
         return rle
 
+    def annsToRLEs(self, anns, num_workers=1):
+        """
+        Convert many annotations to RLE as annToRLE does, in num_workers
+        processes (see mask.frSegmentations).
+        :return: rles (object array) : RLE masks in the order of anns
+        """
+        sizes = [(self.imgs[ann['image_id']]['height'],
+                  self.imgs[ann['image_id']]['width']) for ann in anns]
+        return maskUtils.frSegmentations(
+            [annSegmentation(ann) for ann in anns], sizes, num_workers)
+
     def annToMask(self, ann):
         """
         Convert annotation which can be polygons,
@@ -2,12 +2,20 @@ __author__ = 'tsungyi'
 
 import copy
 import datetime
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
 import time
+import weakref
 from collections import defaultdict
 
 import numpy as np
 
 from . import mask as maskUtils
+from .kernels import (accumulateCurves, bboxIou, bboxOverlaps, denseIous,
+                      greedyMatch, segmentIndex)
 
 
 class COCOeval:
@@ -32,6 +40,19 @@ class COCOeval:
     #  iouType    - ['segm'] set iouType to 'segm', 'bbox' or 'keypoints'
     #  iouType replaced the now DEPRECATED useSegm parameter.
     #  useCats    - [1] if true use category labels for evaluation
+    #  matcher    - ['vectorized'] dt/gt matching engine used by evaluateImg;
+    #  'vectorized' matches all iouThrs at once, 'loop' is the reference.
+    #  With 'vectorized', evaluate() also matches all areaRngs in one pass.
+    #  sparseIouMin - [4096] bbox and segm ious of an image and category
+    #  with at least D*G=sparseIouMin pairs only store the pairs whose boxes
+    #  overlap (see kernels.bboxOverlaps) if all iouThrs>0; None disables.
+    #  keepIous   - [0] if true evaluate() keeps the ious of every image and
+    #  category in self.ious, else those of an image are dropped once matched
+    #  spillDir   - [None] directory to evaluate out of core in: evaluate()
+    #  takes spillCats categories at a time, packs only their anns (and
+    #  masks), drops their ious once matched and keeps evalImgs
+    #  memory-mapped in a temporary directory under it.
+    #  spillCats  - [16] number of categories evaluated at a time out of core
     # Note: if useCats=0 category labels are ignored as in proposal scoring.
     # Note: multiple areaRngs [Ax2] and maxDets [Mx1] can be specified.
     #
@@ -44,6 +65,11 @@ class COCOeval:
     #  dtScores   - [1xD] confidence of each dt
     #  gtIgnore   - [1xG] ignore flag for each gt
     #  dtIgnore   - [TxD] ignore flag for each dt at each IoU
+    # The results are packed column-wise in an EvalImgs store; indexing it
+    # like the former list returns the dict of a single image (or None).
+    # To evaluate in several processes, restrict imgIds to the images of
+    # each, merge their evalImgs with += (or send evalImgs.tobytes()) and
+    # call loadEvalImgs() on the merged store before accumulate().
     #
     # accumulate(): accumulates the per-image, per-category evaluation
     # results in "evalImgs" into the dictionary "eval" with fields:
@@ -60,11 +86,17 @@ class COCOeval:
     # Data, paper, and tutorials available at:  http://mscoco.org/
     # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
     # Licensed under the Simplified BSD License [see coco/license.txt]
-    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', lrp_size_details = False):
+    def __init__(self,
+                 cocoGt=None,
+                 cocoDt=None,
+                 iouType='segm',
+                 lrp_size_details=False,
+                 num_workers=1):
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
         :param cocoDt: coco object with detection results
+        :param num_workers: number of processes used by evaluate()
         :return: None
         '''
         if not iouType:
@@ -76,10 +108,14 @@ class COCOeval:
         self.eval = {}  # accumulated evaluation results
         self._gts = defaultdict(list)  # gt for evaluation
         self._dts = defaultdict(list)  # dt for evaluation
+        self._gtPacked = {}  # gt arrays for evaluation
+        self._dtPacked = {}  # score sorted dt arrays for evaluation
+        self._toPack = None  # anns loaded by _prepare until packed
         self.params = Params(iouType=iouType, lrp_size_details=lrp_size_details)  # parameters
         self._paramsEval = {}  # parameters for evaluation
         self.stats = []  # result summarization
-        self.ious = {}  # ious between all gts and dts
+        self.ious = {}  # ious between gts and dts (all if params.keepIous)
+        self.num_workers = num_workers  # processes for per image evaluation
         if cocoGt is not None:
             self.params.imgIds = sorted(cocoGt.getImgIds())
             self.params.catIds = sorted(cocoGt.getCatIds())
@@ -89,46 +125,182 @@ class COCOeval:
         Prepare ._gts and ._dts for evaluation based on params
         :return: None
         '''
-        def _toMask(anns, coco):
-            # modify ann['segmentation'] by reference
-            for ann in anns:
-                rle = coco.annToRLE(ann)
-                ann['segmentation'] = rle
-
         p = self.params
+        # bbox results are packed from their columns if they have them,
+        # rather than from their anns (see COCO.loadRes)
+        dtColumns = self.cocoDt.annColumns if p.iouType == 'bbox' else None
         if p.useCats:
             gts = self.cocoGt.loadAnns(
                 self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts = self.cocoDt.loadAnns(
+            dts = [] if dtColumns is not None else self.cocoDt.loadAnns(
                 self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
             gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts = self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+            dts = [] if dtColumns is not None else self.cocoDt.loadAnns(
+                self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
-        # convert ground truth to mask if iouType == 'segm'
-        if p.iouType == 'segm':
-            _toMask(gts, self.cocoGt)
-            _toMask(dts, self.cocoDt)
-        # set ignore flag
-        for gt in gts:
-            gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
-            gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
-            if p.iouType == 'keypoints':
-                gt['ignore'] = (gt['num_keypoints'] == 0) or gt['ignore']
+        # ignore flag, the anns are left unchanged
+        gtIgnore = [('iscrowd' in gt and gt['iscrowd'])
+                    or (p.iouType == 'keypoints' and gt['num_keypoints'] == 0)
+                    for gt in gts]
         self._gts = defaultdict(list)  # gt for evaluation
         self._dts = defaultdict(list)  # dt for evaluation
-        for gt in gts:
+        # only the packed anns are used, out of core they are not kept twice
+        for gt in gts if p.spillDir is None else []:
             self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in dts:
+        for dt in dts if p.spillDir is None else []:
             self._dts[dt['image_id'], dt['category_id']].append(dt)
+        self._toPack = (gts, gtIgnore, dts, dtColumns)
+        if p.spillDir is None:
+            self._packCats(None)
+            self._toPack = None
+        else:
+            # packed a chunk of categories at a time by _evaluateOutOfCore
+            self._gtPacked, self._dtPacked = {}, {}
         self.evalImgs = defaultdict(
             list)  # per-image per-category evaluation results
         self.eval = {}  # accumulated evaluation results
 
+    def _packCats(self, catIds):
+        '''
+        Pack the gts and dts loaded by _prepare of the given categories
+        into self._gtPacked and self._dtPacked, with their masks as RLE if
+        iouType == 'segm' (cached by cocoGt, the dt masks are not kept)
+        :param catIds: category ids to pack, None for all
+        :return: None
+        '''
+        p = self.params
+        gts, gtIgnore, dts, dtColumns = self._toPack
+        if catIds is not None:
+            gtInds = np.flatnonzero(
+                np.isin([gt['category_id'] for gt in gts], catIds))
+            gts = [gts[i] for i in gtInds]
+            gtIgnore = [gtIgnore[i] for i in gtInds]
+            dtInds = np.flatnonzero(
+                np.isin([dt['category_id'] for dt in dts], catIds))
+            dts = [dts[i] for i in dtInds]
+            if dtColumns is not None:
+                keep = np.isin(dtColumns['category_id'], catIds)
+                dtColumns = {f: c[keep] for f, c in dtColumns.items()}
+        gtGiven, dtGiven = {'ignore': gtIgnore}, {}
+        if p.iouType == 'segm':
+            gtGiven['rle'] = self.cocoGt.loadRLEs([gt['id'] for gt in gts],
+                                                  self.num_workers)
+            dtGiven['rle'] = self.cocoDt.annsToRLEs(dts, self.num_workers)
+        self._gtPacked = self._packAnns(gts, self._gtFields, gtGiven)
+        if dtColumns is None:
+            self._dtPacked = self._packAnns(dts, self._dtFields, dtGiven)
+        else:
+            self._dtPacked = self._packColumns(dtColumns, self._dtFields)
+
+    # ann fields packed into arrays by _prepare and their dtypes
+    _gtFields = {
+        'id': np.int64,
+        'area': np.float64,
+        'iscrowd': np.uint8,
+        'ignore': bool,
+        'bbox': np.float64,
+    }
+    _dtFields = {
+        'id': np.int64,
+        'score': np.float64,
+        'area': np.float64,
+        'bbox': np.float64,
+    }
+
+    def _packAnns(self, anns, fields, given={}):
+        '''
+        Pack the fields of anns into arrays for every (imgId, catId) pair,
+        with catId -1 for all categories if useCats=0. Within a pair anns
+        keep their order (grouped by category if useCats=0), except that
+        dts are sorted highest score first.
+        :param anns: gts or dts loaded by _prepare
+        :param fields: dict of field dtypes (_gtFields or _dtFields)
+        :param given: dict of lists with a value for each ann, which are
+                      packed instead of the fields of the same name (and
+                      'rle', the masks, which are packed with their boxes)
+        :return: dict of packed anns, each a dict of field arrays and the
+                 anns themselves in the same order under 'anns'
+        '''
+        columns = {
+            f: given[f] if f in given else [ann[f] for ann in anns]
+            for f in list(fields) + ['image_id', 'category_id']
+        }
+        if 'rle' in given:
+            columns['rle'] = given['rle']
+        return self._packColumns(columns, fields, anns)
+
+    def _packColumns(self, columns, fields, anns=None):
+        '''
+        Pack columns of ann fields into arrays for every (imgId, catId)
+        pair as _packAnns does.
+        :param columns: dict of the values of each ann (list or array) for
+                        the fields, 'image_id', 'category_id' and 'rle' if
+                        masks are given
+        :param fields: dict of field dtypes (_gtFields or _dtFields)
+        :param anns: the anns of the columns, which are packed under 'anns'
+                     if given
+        :return: dict of packed anns (see _packAnns)
+        '''
+        p = self.params
+        imgs = _ranks(columns['image_id'], p.imgIds)
+        cats = _ranks(columns['category_id'], p.catIds)
+        keep = np.flatnonzero((imgs >= 0) & (cats >= 0))
+        imgs, cats = imgs[keep], cats[keep]
+        keys = cats if p.useCats else np.zeros_like(cats)
+        order = np.lexsort((cats, imgs))
+        packedColumns = {
+            f: np.asarray(columns[f], dtype=dtype)[keep]
+            for f, dtype in fields.items()
+        }
+        packedColumns['bbox'] = packedColumns['bbox'].reshape((len(keep), 4))
+        if 'rle' in columns:
+            packedColumns['rle'] = np.empty(len(keep), dtype=object)
+            packedColumns['rle'][:] = [columns['rle'][i] for i in keep]
+            # boxes of the masks, which gate the mask ious
+            packedColumns['rleBbox'] = maskUtils.toBbox(
+                list(packedColumns['rle'])).reshape((len(keep), 4))
+        if 'score' in fields:
+            # stable, so ties keep their order as with the former sorts
+            order = order[np.lexsort(
+                (-packedColumns['score'][order], keys[order], imgs[order]))]
+        imgs, keys = imgs[order], keys[order]
+        starts = np.flatnonzero(
+            np.diff(imgs, prepend=-1) | np.diff(keys, prepend=-1))
+        ends = np.append(starts[1:], len(order))
+        packed = {}
+        for s, e in zip(starts, ends):
+            inds = order[s:e]
+            catId = p.catIds[keys[s]] if p.useCats else -1
+            packed[p.imgIds[imgs[s]],
+                   catId] = {f: c[inds]
+                             for f, c in packedColumns.items()}
+            if anns is not None:
+                packed[p.imgIds[imgs[s]],
+                       catId]['anns'] = [anns[keep[i]] for i in inds]
+        return packed
+
+    def _getPacked(self, imgId, catId):
+        '''
+        Packed gts and dts of an image and category
+        :return: gt, dt dicts of arrays (see _packAnns), or None, None
+                 if there are neither gts nor dts
+        '''
+        key = (imgId, catId if self.params.useCats else -1)
+        gt = self._gtPacked.get(key)
+        dt = self._dtPacked.get(key)
+        if gt is None and dt is None:
+            return None, None
+        if gt is None:
+            gt = _emptyPacked(self._gtFields)
+        if dt is None:
+            dt = _emptyPacked(self._dtFields)
+        return gt, dt
+
     def evaluate(self):
         '''
         Run per image evaluation on given images and store results
-         (a list of dict) in self.evalImgs
+         (an EvalImgs store) in self.evalImgs
         :return: None
         '''
         tic = time.time()
@@ -147,104 +319,316 @@ class COCOeval:
         self.params = p
 
         self._prepare()
-        # loop through images, area range, max detection number
+        if p.spillDir is not None:
+            self._evaluateOutOfCore()
+        elif self.num_workers > 1:
+            self._evaluateParallel()
+        else:
+            self._evaluateImgs()
+        self._paramsEval = _copyParams(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc - tic))
+
+    def _evaluateImgs(self):
+        '''
+        Compute self.ious and self.evalImgs for every image in params
+        :return: None
+        '''
+        p = self.params
         catIds = p.catIds if p.useCats else [-1]
+        self.ious = {}
+        self.evalImgs = EvalImgs(p.imgIds, catIds, p.areaRng, p.maxDets[-1],
+                                 len(p.iouThrs))
+        self._evaluateCats(range(len(catIds)))
 
-        if p.iouType == 'segm' or p.iouType == 'bbox':
+    def _evaluateCats(self, ks):
+        '''
+        Add the results of the categories at positions ks of the category
+        axis to self.evalImgs, one image at a time: the ious of an image
+        are computed, matched and dropped unless params.keepIous, in which
+        case they are kept in self.ious. Only the (image, category) pairs
+        with gts or dts are evaluated, the results of all others are None.
+        :param ks: increasing category positions
+        :return: None
+        '''
+        p = self.params
+        if p.iouType == 'segm':
             computeIoU = self.computeIoU
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
-        self.ious = {(imgId, catId): computeIoU(imgId, catId)
-                     for imgId in p.imgIds for catId in catIds}
-
-        evaluateImg = self.evaluateImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [
-            evaluateImg(imgId, catId, areaRng, maxDet) for catId in catIds
-            for areaRng in p.areaRng for imgId in p.imgIds
+        A0, I0 = len(p.areaRng), len(p.imgIds)
+        # loop through images, area range, max detection number
+        for i, imgId, imgKs, catIds in self._evalPairs(ks):
+            if p.iouType == 'bbox':
+                # all categories of an image at once
+                ious = self.computeBboxIoUs(imgId, catIds)
+            else:
+                ious = {(imgId, catId): computeIoU(imgId, catId)
+                        for catId in catIds}
+            self.ious.update(ious)
+            cells, E = [], []
+            for k, catId in zip(imgKs, catIds):
+                cells += [k * A0 * I0 + a * I0 + i for a in range(A0)]
+                if p.matcher == 'vectorized':
+                    # one match pass covers all area ranges
+                    E += self.evaluateImgAreas(imgId, catId, p.areaRng, maxDet)
+                else:
+                    E += [
+                        self.evaluateImg(imgId, catId, areaRng, maxDet)
+                        for areaRng in p.areaRng
+                    ]
+            self.evalImgs.extend(cells, E)
+            if not p.keepIous:
+                for key in ious:
+                    del self.ious[key]
+
+    def _evalPairs(self, ks):
+        '''
+        Group the (image, category) pairs with gts or dts of the categories
+        at positions ks by image
+        :param ks: increasing category positions
+        :return: list of (i, imgId, ks, catIds) in the order of the images,
+                 with the positions and ids of the categories of image i
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        imgPos = {imgId: i for i, imgId in enumerate(p.imgIds)}
+        catPos = {catIds[k]: k for k in ks}
+        pairs = set(self._gtPacked) | set(self._dtPacked)
+        pairs = sorted((imgPos[imgId], catPos[catId]) for imgId, catId in pairs
+                       if imgId in imgPos and catId in catPos)
+        groups = []
+        for i, k in pairs:
+            if not groups or groups[-1][0] != i:
+                groups.append((i, p.imgIds[i], [], []))
+            groups[-1][2].append(k)
+            groups[-1][3].append(catIds[k])
+        return groups
+
+    def _evaluateParallel(self):
+        '''
+        Shard images over self.num_workers processes, each running
+        _evaluateImgs on its shard, and merge the results back into the
+        [KxAxI] order of evalImgs expected by accumulate()
+        :return: None
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        self.ious = {}
+        self.evalImgs = EvalImgs(p.imgIds, catIds, p.areaRng, p.maxDets[-1],
+                                 len(p.iouThrs))
+        workers = multiprocessing.Pool(processes=self.num_workers)
+        self._evaluateCatsParallel(range(len(catIds)), workers)
+        workers.close()
+        workers.join()
+
+    def _evaluateCatsParallel(self, ks, workers):
+        '''
+        _evaluateCats over shards of the images in a pool of workers
+        :param ks: increasing category positions
+        :param workers: multiprocessing pool
+        :return: None
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        keys = set(catIds[k] for k in ks)
+        # a few shards per worker keep the processes evenly loaded
+        splits = [
+            s for s in np.array_split(p.imgIds, self.num_workers * 4)
+            if len(s) > 0
         ]
-        self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc - tic))
+        shard = {imgId: n for n, s in enumerate(splits) for imgId in s}
+        shards = []
+        for s in splits:
+            E = copy.copy(self)
+            E.cocoGt, E.cocoDt = None, None
+            E.params = copy.copy(p)
+            E.params.imgIds = list(s)
+            E._gts, E._dts = defaultdict(list), defaultdict(list)
+            E._gtPacked, E._dtPacked = {}, {}
+            E.ious, E.evalImgs = {}, None
+            E._toPack = None
+            shards.append((E, ks))
+        for key, gt in self._gtPacked.items():
+            if key[0] in shard and key[1] in keys:
+                shards[shard[key[0]]][0]._gtPacked[key] = gt
+        for key, dt in self._dtPacked.items():
+            if key[0] in shard and key[1] in keys:
+                shards[shard[key[0]]][0]._dtPacked[key] = dt
+
+        results = workers.map(_evaluateShard, shards, chunksize=1)
+        for ious, evalImgs in results:
+            self.ious.update(ious)
+            self.evalImgs._merge(evalImgs)
+
+    def _evaluateOutOfCore(self):
+        '''
+        Evaluate params.spillCats categories at a time into an EvalImgs
+        store spilled to params.spillDir; the ious kept with keepIous are
+        dropped with each chunk of categories, so self.ious stays empty
+        :return: None
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        self.ious = {}
+        self.evalImgs = EvalImgs(p.imgIds, catIds, p.areaRng, p.maxDets[-1],
+                                 len(p.iouThrs))
+        self.evalImgs.spill(p.spillDir)
+        workers = None
+        if self.num_workers > 1:
+            workers = multiprocessing.Pool(processes=self.num_workers)
+        for k0 in range(0, len(catIds), p.spillCats):
+            ks = range(k0, min(k0 + p.spillCats, len(catIds)))
+            # only the anns of the chunk are packed
+            self._packCats([catIds[k] for k in ks] if p.useCats else None)
+            if workers is None:
+                self._evaluateCats(ks)
+            else:
+                self._evaluateCatsParallel(ks, workers)
+            self._gtPacked, self._dtPacked = {}, {}
+            self.ious = {}
+            # append the results of the chunk to the files of the store
+            self.evalImgs._consolidate()
+        self._toPack = None
+        if workers is not None:
+            workers.close()
+            workers.join()
+
+    def loadEvalImgs(self, evalImgs):
+        '''
+        Use an EvalImgs store evaluated elsewhere, e.g. merged with += from
+        the stores of several processes, in place of evaluate(); the params
+        must be those used to evaluate it, except for imgIds
+        :param evalImgs: EvalImgs store
+        :return: None
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        if (list(catIds) != evalImgs.catIds
+                or not np.array_equal(p.areaRng, evalImgs.areaRng)
+                or max(p.maxDets) != evalImgs.maxDet
+                or len(p.iouThrs) != evalImgs.T):
+            raise Exception('evalImgs were evaluated with different params')
+        p.imgIds = list(evalImgs.imgIds)
+        p.maxDets = sorted(p.maxDets)
+        self.evalImgs = evalImgs
+        self._paramsEval = _copyParams(p)
 
     def computeIoU(self, imgId, catId):
         p = self.params
-        if p.useCats:
-            gt = self._gts[imgId, catId]
-            dt = self._dts[imgId, catId]
-        else:
-            gt = [_ for cId in p.catIds for _ in self._gts[imgId, cId]]
-            dt = [_ for cId in p.catIds for _ in self._dts[imgId, cId]]
-        if len(gt) == 0 and len(dt) == 0:
+        gt, dt = self._getPacked(imgId, catId)
+        if gt is None or len(gt['id']) == 0 or len(dt['id']) == 0:
             return []
-        inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in inds]
-        if len(dt) > p.maxDets[-1]:
-            dt = dt[0:p.maxDets[-1]]
+        maxDet = p.maxDets[-1]
 
         if p.iouType == 'segm':
-            g = [g['segmentation'] for g in gt]
-            d = [d['segmentation'] for d in dt]
+            g = list(gt['rle'])
+            d = list(dt['rle'][0:maxDet])
         elif p.iouType == 'bbox':
-            g = [g['bbox'] for g in gt]
-            d = [d['bbox'] for d in dt]
+            g = gt['bbox']
+            d = dt['bbox'][0:maxDet]
         else:
             raise Exception('unknown iouType for iou computation')
+        if len(d) == 0 or len(g) == 0:
+            return []
+        if p.iouType == 'bbox':
+            return bboxIou(d, g, gt['iscrowd'])
+
+        # compute iou between each dt and gt region whose boxes overlap
+        ious = maskUtils.sparseIou(d, g, gt['iscrowd'],
+                                   dt['rleBbox'][0:maxDet], gt['rleBbox'])
+        if not self._sparseIous(len(d), len(g)):
+            ious = denseIous(ious, len(d), len(g))
+        return ious
 
-        # compute iou between each dt and gt region
-        iscrowd = [int(o['iscrowd']) for o in gt]
-        ious = maskUtils.iou(d, g, iscrowd)
+    def computeBboxIoUs(self, imgId, catIds):
+        '''
+        Compute the bbox ious of all given categories of an image with one
+        call, giving the same result as computeIoU(imgId, catId) for each.
+        Blocks of at least params.sparseIouMin pairs are kept sparse.
+        :return: dict of ious for each (imgId, catId)
+        '''
+        p = self.params
+        maxDet = p.maxDets[-1]
+        ious, blocks = {}, []
+        for catId in catIds:
+            key = (imgId, catId if p.useCats else -1)
+            ious[imgId, catId] = []
+            if key not in self._gtPacked or key not in self._dtPacked:
+                continue
+            gt = self._gtPacked[key]
+            d = self._dtPacked[key]['bbox'][0:maxDet]
+            if self._sparseIous(len(d), len(gt['bbox'])):
+                # large blocks keep the overlapping pairs only
+                ious[imgId, catId] = bboxOverlaps(d, gt['bbox'], gt['iscrowd'])
+            else:
+                blocks.append((catId, d, gt))
+        if not blocks:
+            return ious
+        # ious of all dt and gt pairs of the image, cut into category blocks
+        o = bboxIou(np.concatenate([d for _, d, _ in blocks]),
+                    np.concatenate([gt['bbox'] for _, _, gt in blocks]),
+                    np.concatenate([gt['iscrowd'] for _, _, gt in blocks]))
+        d0 = g0 = 0
+        for catId, d, gt in blocks:
+            d1, g1 = d0 + len(d), g0 + len(gt['bbox'])
+            ious[imgId, catId] = o[d0:d1, g0:g1]
+            d0, g0 = d1, g1
         return ious
 
+    def _sparseIous(self, D, G):
+        # whether the ious of D dts and G gts are stored sparse
+        p = self.params
+        return (p.sparseIouMin is not None and min(p.iouThrs) > 0
+                and D * G >= p.sparseIouMin)
+
     def computeOks(self, imgId, catId):
         p = self.params
         # dimention here should be Nxm
-        gts = self._gts[imgId, catId]
-        dts = self._dts[imgId, catId]
-        inds = np.argsort([-d['score'] for d in dts], kind='mergesort')
-        dts = [dts[i] for i in inds]
-        if len(dts) > p.maxDets[-1]:
-            dts = dts[0:p.maxDets[-1]]
+        gt, dt = self._getPacked(imgId, catId)
         # if len(gts) == 0 and len(dts) == 0:
-        if len(gts) == 0 or len(dts) == 0:
+        if gt is None or len(gt['id']) == 0 or len(dt['id']) == 0:
             return []
-        ious = np.zeros((len(dts), len(gts)))
+        gts = gt['anns']
+        dts = dt['anns'][0:p.maxDets[-1]]
         sigmas = p.kpt_oks_sigmas
         vars = (sigmas * 2)**2
-        k = len(sigmas)
-        # compute oks between each detection and ground truth object
-        for j, gt in enumerate(gts):
-            # create bounds for ignore regions(double the gt bbox)
-            g = np.array(gt['keypoints'])
-            xg = g[0::3]
-            yg = g[1::3]
-            vg = g[2::3]
-            k1 = np.count_nonzero(vg > 0)
-            bb = gt['bbox']
-            x0 = bb[0] - bb[2]
-            x1 = bb[0] + bb[2] * 2
-            y0 = bb[1] - bb[3]
-            y1 = bb[1] + bb[3] * 2
-            for i, dt in enumerate(dts):
-                d = np.array(dt['keypoints'])
-                xd = d[0::3]
-                yd = d[1::3]
-                if k1 > 0:
-                    # measure the per-keypoint distance if keypoints visible
-                    dx = xd - xg
-                    dy = yd - yg
-                else:
-                    # measure minimum distance to keypoints in (x0,y0) &
-                    # (x1,y1)
-                    z = np.zeros((k))
-                    dx = np.max((z, x0 - xd), axis=0) + \
-                        np.max((z, xd - x1), axis=0)
-                    dy = np.max((z, y0 - yd), axis=0) + \
-                        np.max((z, yd - y1), axis=0)
-                e = (dx**2 + dy**2) / vars / (gt['area'] + np.spacing(1)) / 2
-                if k1 > 0:
-                    e = e[vg > 0]
-                ious[i, j] = np.sum(np.exp(-e)) / e.shape[0]
+        # pack keypoints as [DxKx3] and [GxKx3] and compute the oks between
+        # all detections and ground truth objects at once ([DxGxK] below)
+        d = np.array([dt['keypoints'] for dt in dts], dtype=float).reshape(
+            (len(dts), -1, 3))
+        g = np.array([gt['keypoints'] for gt in gts], dtype=float).reshape(
+            (len(gts), -1, 3))
+        xd, yd = d[:, None, :, 0], d[:, None, :, 1]
+        xg, yg, vg = g[None, :, :, 0], g[None, :, :, 1], g[None, :, :, 2] > 0
+        # create bounds for ignore regions(double the gt bbox)
+        bb = gt['bbox']
+        x0 = (bb[:, 0] - bb[:, 2])[None, :, None]
+        x1 = (bb[:, 0] + bb[:, 2] * 2)[None, :, None]
+        y0 = (bb[:, 1] - bb[:, 3])[None, :, None]
+        y1 = (bb[:, 1] + bb[:, 3] * 2)[None, :, None]
+        # measure the per-keypoint distance if keypoints visible, else the
+        # minimum distance to keypoints in (x0,y0) & (x1,y1)
+        visible = vg.any(axis=2, keepdims=True)
+        dx = np.where(visible, xd - xg,
+                      np.maximum(0, x0 - xd) + np.maximum(0, xd - x1))
+        dy = np.where(visible, yd - yg,
+                      np.maximum(0, y0 - yd) + np.maximum(0, yd - y1))
+        area = gt['area'][None, :, None]
+        e = (dx**2 + dy**2) / vars / (area + np.spacing(1)) / 2
+        # average over the visible keypoints, or all if none is visible; gts
+        # with as many of them are summed together so that every sum adds
+        # the same values in the same order as for a single pair
+        valid = (vg | ~visible)[0]
+        oks = np.exp(-e)
+        ious = np.zeros((len(dts), len(gts)))
+        counts = valid.sum(axis=1)
+        for n in np.unique(counts):
+            j = np.flatnonzero(counts == n)
+            kp = np.nonzero(valid[j])[1].reshape((len(j), n))
+            oksj = np.take_along_axis(oks[:, j], kp[None], axis=2)
+            ious[:, j] = np.sum(oksj, axis=2) / n
         return ious
 
     def evaluateImg(self, imgId, catId, aRng, maxDet):
@@ -253,46 +637,123 @@ class COCOeval:
         :return: dict (single image results)
         '''
         p = self.params
-        if p.useCats:
-            gt = self._gts[imgId, catId]
-            dt = self._dts[imgId, catId]
-        else:
-            gt = [_ for cId in p.catIds for _ in self._gts[imgId, cId]]
-            dt = [_ for cId in p.catIds for _ in self._dts[imgId, cId]]
-        if len(gt) == 0 and len(dt) == 0:
+        gt, dt = self._getPacked(imgId, catId)
+        if gt is None:
             return None
 
-        for g in gt:
-            if g['ignore'] or (g['area'] < aRng[0] or g['area'] > aRng[1]):
-                g['_ignore'] = 1
-            else:
-                g['_ignore'] = 0
-
-        # sort dt highest score first, sort gt ignore last
-        gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
-        gt = [gt[i] for i in gtind]
-        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in dtind[0:maxDet]]
-        iscrowd = [int(o['iscrowd']) for o in gt]
+        gtIg = (gt['ignore'] | (gt['area'] < aRng[0]) |
+                (gt['area'] > aRng[1])).astype(int)
+
+        # dt are sorted highest score first, sort gt ignore last
+        gtind = np.argsort(gtIg, kind='mergesort')
+        gtIg = gtIg[gtind]
+        gtIds = gt['id'][gtind]
+        iscrowd = gt['iscrowd'][gtind]
+        dtIds = dt['id'][0:maxDet]
+        dtArea = dt['area'][0:maxDet]
         # load computed ious
-        ious = self.ious[imgId, catId][:, gtind] if len(
-            self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
+        ious = self.ious[imgId, catId]
+        if isinstance(ious, tuple):
+            ious = denseIous(ious, len(dtIds), len(gtIds))
+        ious = ious[:, gtind] if len(ious) > 0 else ious
+
+        T = len(p.iouThrs)
+        if p.matcher == 'vectorized':
+            dtm, gtm, dtIg, dtIoU = greedyMatch(ious, p.iouThrs, gtIg, iscrowd,
+                                                dtIds, gtIds)
+        elif p.matcher == 'loop':
+            dtm, gtm, dtIg, dtIoU = self._loopMatch(ious, gtIg, iscrowd, dtIds,
+                                                    gtIds)
+        else:
+            raise Exception('unknown matcher for evaluation')
+        # set unmatched detections outside of area range to ignore
+        a = ((dtArea < aRng[0]) | (dtArea > aRng[1])).reshape((1, len(dtIds)))
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T,
+                                                                      0)))
+        # store results for given image and category
+        return {
+            'image_id': imgId,
+            'category_id': catId,
+            'aRng': aRng,
+            'maxDet': maxDet,
+            'dtIds': dtIds.tolist(),
+            'gtIds': gtIds.tolist(),
+            'dtMatches': dtm,
+            'gtMatches': gtm,
+            'dtScores': dt['score'][0:maxDet].tolist(),
+            'gtIgnore': gtIg,
+            'dtIgnore': dtIg,
+            'dtIoUs': dtIoU,
+        }
 
+    def evaluateImgAreas(self, imgId, catId, areaRngs, maxDet):
+        '''
+        perform evaluation for single category and image on all area ranges
+        at once. The dt sort, the ious and the match pass are shared; only
+        the area dependent ignore flags differ between the results.
+        :return: list of dict (single image results for each area range)
+        '''
+        p = self.params
+        gt, dt = self._getPacked(imgId, catId)
+        if gt is None:
+            return [None] * len(areaRngs)
+
+        # dt are sorted highest score first
+        aRngs = np.array(areaRngs, dtype=float).reshape((-1, 2))
+        lo, hi = aRngs[:, 0:1], aRngs[:, 1:2]
+        gtIg = (gt['ignore'] | (gt['area'] < lo) |
+                (gt['area'] > hi)).astype(int)
+        dtArea = dt['area'][0:maxDet]
+        dtOut = (dtArea < lo) | (dtArea > hi)
+        dtIds = dt['id'][0:maxDet]
+        gtIds = gt['id']
+        dtm, gtm, dtIg, dtIoU = greedyMatch(self.ious[imgId, catId], p.iouThrs,
+                                            gtIg, gt['iscrowd'], dtIds, gtIds)
+        dtIds = dtIds.tolist()
+        dtScores = dt['score'][0:maxDet].tolist()
+        E = []
+        for a, aRng in enumerate(areaRngs):
+            # report gts ignore last as evaluateImg does
+            gtind = np.argsort(gtIg[a], kind='mergesort')
+            # set unmatched detections outside of area range to ignore
+            dtIgnore = np.logical_or(dtIg[a],
+                                     np.logical_and(dtm[a] == 0, dtOut[a]))
+            E.append({
+                'image_id': imgId,
+                'category_id': catId,
+                'aRng': aRng,
+                'maxDet': maxDet,
+                'dtIds': dtIds,
+                'gtIds': gtIds[gtind].tolist(),
+                'dtMatches': dtm[a],
+                'gtMatches': gtm[a][:, gtind],
+                'dtScores': dtScores,
+                'gtIgnore': gtIg[a][gtind],
+                'dtIgnore': dtIgnore,
+                'dtIoUs': dtIoU[a],
+            })
+        return E
+
+    def _loopMatch(self, ious, gtIg, iscrowd, dtIds, gtIds):
+        '''
+        reference greedy matching of sorted dts to ignore-last sorted gts
+        :return: dtm, gtm, dtIg, dtIoU arrays as in evaluateImg
+        '''
+        p = self.params
         T = len(p.iouThrs)
-        G = len(gt)
-        D = len(dt)
+        G = len(gtIds)
+        D = len(dtIds)
         gtm = np.zeros((T, G))
         dtm = np.zeros((T, D))
-        gtIg = np.array([g['_ignore'] for g in gt])
         dtIg = np.zeros((T, D))
         dtIoU = np.zeros((T, D))
         if not len(ious) == 0:
             for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
+                for dind, d in enumerate(dtIds):
                     # information about best match so far (m=-1 -> unmatched)
                     iou = min([t, 1 - 1e-10])
                     m = -1
-                    for gind, g in enumerate(gt):
+                    for gind, g in enumerate(gtIds):
                         # if this gt already matched, and not a crowd, continue
                         if gtm[tind, gind] > 0 and not iscrowd[gind]:
                             continue
@@ -310,29 +771,10 @@ class COCOeval:
                     if m == -1:
                         continue
                     dtIg[tind, dind] = gtIg[m]
-                    dtm[tind, dind] = gt[m]['id']
-                    gtm[tind, m] = d['id']
+                    dtm[tind, dind] = gtIds[m]
+                    gtm[tind, m] = d
                     dtIoU[tind, dind] = iou
-        # set unmatched detections outside of area range to ignore
-        a = np.array([d['area'] < aRng[0] or d['area'] > aRng[1]
-                      for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T,
-                                                                      0)))
-        # store results for given image and category
-        return {
-            'image_id': imgId,
-            'category_id': catId,
-            'aRng': aRng,
-            'maxDet': maxDet,
-            'dtIds': [d['id'] for d in dt],
-            'gtIds': [g['id'] for g in gt],
-            'dtMatches': dtm,
-            'gtMatches': gtm,
-            'dtScores': [d['score'] for d in dt],
-            'gtIgnore': gtIg,
-            'dtIgnore': dtIg,
-            'dtIoUs': dtIoU,
-        }
+        return dtm, gtm, dtIg, dtIoU
 
     def accumulate(self, p=None):
         '''
@@ -380,19 +822,26 @@ class COCOeval:
         ]
         i_list = [n for n, i in enumerate(p.imgIds) if i in setI]
         I0 = len(_pe.imgIds)
-        A0 = len(_pe.areaRng)
+        evalImgs = self.evalImgs
+        if not isinstance(evalImgs, EvalImgs):
+            # pack evaluateImg dicts assigned to evalImgs by hand
+            evalImgs = EvalImgs(_pe.imgIds, catIds, _pe.areaRng,
+                                _pe.maxDets[-1], len(_pe.iouThrs))
+            evalImgs.extend(range(len(self.evalImgs)), self.evalImgs)
+        # the images to accumulate, None for all
+        imgMask = None
+        if len(i_list) != I0:
+            imgMask = np.zeros(I0, dtype=bool)
+            imgMask[[i for i in i_list if i < I0]] = True
         # retrieve E at each category, area range, and max number of detections
         for k, k0 in enumerate(k_list):
-            Nk = k0 * A0 * I0
             for a, a0 in enumerate(a_list):
-                Na = a0 * I0
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk + Na + i] for i in i_list]
-                    E = [e for e in E if e is not None]
-                    if len(E) == 0:
+                    dind, gind, nE = evalImgs.gatherSetting(
+                        k0, a0, maxDet, imgMask)
+                    if nE == 0:
                         continue
-                    dtScores = np.concatenate(
-                        [e['dtScores'][0:maxDet] for e in E])
+                    dtScores = evalImgs.dtScores[dind]
 
                     # different sorting method generates slightly
                     # different results.
@@ -401,93 +850,25 @@ class COCOeval:
                     inds = np.argsort(-dtScores, kind='mergesort')
                     dtScoresSorted = dtScores[inds]
 
-                    dtm = np.concatenate(
-                        [e['dtMatches'][:, 0:maxDet] for e in E], axis=1)[:,
-                                                                          inds]
-                    dtIg = np.concatenate(
-                        [e['dtIgnore'][:, 0:maxDet] for e in E], axis=1)[:,
-                                                                         inds]
-                    dtIoU = np.concatenate(
-                        [e['dtIoUs'][:, 0:maxDet] for e in E], axis=1)[:, inds]
+                    dind = dind[inds]
+                    dtm = evalImgs.dtMatches[:, dind]
+                    dtIg = evalImgs.dtIgnore[:, dind]
+                    dtIoU = evalImgs.dtIoUs[:, dind]
 
-                    gtIg = np.concatenate([e['gtIgnore'] for e in E])
+                    gtIg = evalImgs.gtIgnore[gind]
                     npig = np.count_nonzero(gtIg == 0)
                     if npig == 0:
                         continue
-                    tps = np.logical_and(dtm, np.logical_not(dtIg))
-                    fps = np.logical_and(np.logical_not(dtm),
-                                         np.logical_not(dtIg))
-
-                    dtIoU = np.multiply(dtIoU, tps)
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
-                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                        tp = np.array(tp)
-                        fp = np.array(fp)
-                        nd = len(tp)
-                        rc = tp / npig
-                        pr = tp / (fp + tp + np.spacing(1))
-                        q = np.zeros((R, ))
-                        ss = np.zeros((R, ))
-
-                        if nd:
-                            recall[t, k, a, m] = rc[-1]
-                        else:
-                            recall[t, k, a, m] = 0
-
-                        # numpy is slow without cython optimization
-                        # for accessing elements use python array
-                        # gets significant speed improvement
-                        pr = pr.tolist()
-                        q = q.tolist()
-
-                        for i in range(nd - 1, 0, -1):
-                            if pr[i] > pr[i - 1]:
-                                pr[i - 1] = pr[i]
-
-                        inds = np.searchsorted(rc, p.recThrs, side='left')
-                        try:
-                            for ri, pi in enumerate(inds):
-                                q[ri] = pr[pi]
-                                ss[ri] = dtScoresSorted[pi]
-                        except BaseException:
-                            pass
-                        precision[t, :, k, a, m] = np.array(q)
-                        scores[t, :, k, a, m] = np.array(ss)
-
-                    # oLRP and Opt.Thr. Computation
-                    tp_num = np.cumsum(tps[0, :])
-                    fp_num = np.cumsum(fps[0, :])
-                    fn_num = npig - tp_num
-                    # If there is detection
-                    if tp_num.shape[0] > 0:
-                        # There is some TPs
-                        if tp_num[-1] > 0:
-                            total_loc = tp_num - np.cumsum(dtIoU[0, :])
-                            lrps = (total_loc / (1 - _pe.iouThrs[0]) + fp_num +
-                                    fn_num) / (tp_num + fp_num + fn_num)
-                            opt_pos_idx = np.argmin(lrps)
-                            olrp[k, a, m] = lrps[opt_pos_idx]
-                            olrp_loc[k, a, m] = total_loc[opt_pos_idx] / \
-                                tp_num[opt_pos_idx]
-                            olrp_fp[k, a, m] = fp_num[opt_pos_idx] / \
-                                (tp_num[opt_pos_idx] + fp_num[opt_pos_idx])
-                            olrp_fn[k, a, m] = fn_num[opt_pos_idx] / npig
-                            lrp_opt_thr[k, a, m] = dtScoresSorted[opt_pos_idx]
-                        # There is No TP
-                        else:
-                            olrp_loc[k, a, m] = np.nan
-                            olrp_fp[k, a, m] = np.nan
-                            olrp_fn[k, a, m] = 1.
-                            olrp[k, a, m] = 1.
-                            lrp_opt_thr[k, a, m] = np.nan
-                    # No detection
-                    else:
-                        olrp_loc[k, a, m] = np.nan
-                        olrp_fp[k, a, m] = np.nan
-                        olrp_fn[k, a, m] = 1.
-                        olrp[k, a, m] = 1.
-                        lrp_opt_thr[k, a, m] = np.nan
+                    pr, rc, ss, lrp = accumulateCurves(dtm, dtIg, dtIoU,
+                                                       dtScoresSorted, npig,
+                                                       p.recThrs,
+                                                       _pe.iouThrs[0])
+                    precision[:, :, k, a, m] = pr
+                    recall[:, k, a, m] = rc
+                    scores[:, :, k, a, m] = ss
+                    # oLRP and Opt.Thr.
+                    olrp[k, a, m], olrp_loc[k, a, m], olrp_fp[k, a, m], \
+                        olrp_fn[k, a, m], lrp_opt_thr[k, a, m] = lrp
         self.eval = {
             'params': p,
             'counts': [T, R, K, A, M],
@@ -793,6 +1174,511 @@ class COCOeval:
         self.summarize()
 
 
+class StreamingCOCOeval(COCOeval):
+    # Interface for evaluating detections batch by batch, e.g. while they
+    # are produced by a model, without collecting all results first.
+    #
+    # The usage for StreamingCOCOeval is as follows:
+    #  cocoGt=...                         # load dataset
+    #  E = StreamingCOCOeval(cocoGt);     # initialize with the gt only
+    #  E.params.recThrs = ...;            # set parameters before any update
+    #  E.update(imgIds,dets);             # evaluate a batch of images
+    #  E.accumulate();                    # accumulate the images seen so far
+    #  E.summarize();                     # display summary metrics of results
+    #
+    # update() takes the ids of the images of a batch and their results in
+    # the format accepted by COCO.loadRes. All results of an image must be
+    # given in the same update; images without results still count their
+    # gts. Only the per-image matches are kept (in the EvalImgs store
+    # self.evalImgs), so accumulate() and summarize() can be called after
+    # any update and give the same results as evaluate() would on the
+    # images seen so far. The ious of a batch are not kept.
+    def __init__(self,
+                 cocoGt=None,
+                 iouType='segm',
+                 lrp_size_details=False,
+                 num_workers=1):
+        '''
+        Initialize StreamingCOCOeval using the coco api for gt
+        :param cocoGt: coco object with ground truth annotations
+        :param num_workers: number of processes used by update()
+        :return: None
+        '''
+        super().__init__(cocoGt, None, iouType, lrp_size_details, num_workers)
+        self.imgIdsSeen = set()  # images evaluated so far
+        self._numDts = 0  # results loaded so far, used to number dt ids
+
+    def evaluate(self):
+        raise Exception('use update() to evaluate batches of results')
+
+    def update(self, imgIds, dets):
+        '''
+        Evaluate the results of a batch of images and add the per image
+        results to self.evalImgs
+        :param imgIds: ids of the images of the batch
+        :param dets: results of these images (list of dicts)
+        :return: None
+        '''
+        tic = time.time()
+        if not isinstance(self.evalImgs, EvalImgs):
+            self._start()
+        p = self._paramsEval
+        imgIds = set(np.atleast_1d(imgIds).tolist())
+        if not set(dt['image_id'] for dt in dets) <= imgIds:
+            raise Exception('results given for images outside the batch')
+        if imgIds & self.imgIdsSeen:
+            raise Exception('images of the batch were already evaluated')
+
+        # evaluate the batch as a copy restricted to its images
+        E = copy.copy(self)
+        E.cocoDt = self._loadRes(dets)
+        E.params = copy.copy(p)
+        E.params.imgIds = [imgId for imgId in p.imgIds if imgId in imgIds]
+        E._prepare()
+        if self.num_workers > 1:
+            E._evaluateParallel()
+        else:
+            E._evaluateImgs()
+        self.evalImgs._merge(E.evalImgs)
+        # only once evaluated, a failed batch can be given again
+        self.imgIdsSeen |= imgIds
+        toc = time.time()
+        print('Evaluated {} images (t={:0.2f}s).'.format(
+            len(E.params.imgIds), toc - tic))
+
+    def _start(self):
+        # fix the parameters and the layout of evalImgs at the first update
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self._paramsEval = _copyParams(p)
+        catIds = p.catIds if p.useCats else [-1]
+        self.evalImgs = EvalImgs(p.imgIds, catIds, p.areaRng, p.maxDets[-1],
+                                 len(p.iouThrs))
+
+    def _loadRes(self, dets):
+        # coco object of a batch with dt ids unique over all batches
+        if len(dets) == 0:
+            return type(self.cocoGt)()
+        cocoDt = self.cocoGt.loadRes(dets)
+        for dt in cocoDt.dataset['annotations']:
+            dt['id'] += self._numDts
+        cocoDt.createIndex()
+        self._numDts += len(dets)
+        return cocoDt
+
+
+class EvalImgs:
+    '''
+    Columnar store for the per-image results of COCOeval.evaluate().
+    Only non-empty (category, area range, image) cells are kept, keyed by
+    their position k*A*I + a*I + i in the [KxAxI] layout of evalImgs, and
+    sorted: gatherSetting() finds the cells of a category and area range
+    as one range of them. Each cell owns a contiguous slice of the packed
+    dt and gt arrays given by dtOffsets and gtOffsets, so accumulate()
+    gathers cells with array indexing. Indexing the store returns the
+    evaluateImg dict of a cell (or None), built on demand for
+    compatibility with the list layout.
+    Stores of disjoint sets of images are merged with += and serialized
+    with tobytes()/frombytes(), so that per image evaluation can be split
+    over processes or machines and only the stores are sent back.
+    A store can be spilled to disk with spill(): its arrays are then kept
+    in files, one per field ([TxN] fields transposed, so that chunks of
+    cells following the stored ones are appended), and memory-mapped.
+    '''
+    dtFields = ('dtIds', 'dtScores')  # [N] per detection
+    dtThrFields = ('dtMatches', 'dtIgnore', 'dtIoUs')  # [TxN]
+    gtFields = ('gtIds', 'gtIgnore')  # [M] per ground truth
+    gtThrFields = ('gtMatches', )  # [TxM]
+    dtypes = {
+        'dtIds': np.int64,
+        'dtScores': np.float64,
+        'dtMatches': np.float64,
+        'dtIgnore': bool,
+        'dtIoUs': np.float64,
+        'gtIds': np.int64,
+        'gtIgnore': np.uint8,
+        'gtMatches': np.float64,
+    }
+    # fields of the dict view in order, lists are returned as lists
+    viewFields = ('dtIds', 'gtIds', 'dtMatches', 'gtMatches', 'dtScores',
+                  'gtIgnore', 'dtIgnore', 'dtIoUs')
+    listFields = ('dtIds', 'gtIds', 'dtScores')
+
+    def __init__(self, imgIds, catIds, areaRng, maxDet, T):
+        '''
+        :param imgIds, catIds, areaRng: the I, K and A axes of the layout
+        :param maxDet: max detections per image kept by evaluateImg
+        :param T: number of IoU thresholds
+        '''
+        self.imgIds = list(imgIds)
+        self.catIds = list(catIds)
+        self.areaRng = list(areaRng)
+        self.maxDet = maxDet
+        self.T = T
+        self._chunks = []
+        self._spillDir = None  # directory of the files of a spilled store
+        self._setChunk(self._packChunk([], []))
+
+    def __len__(self):
+        return len(self.catIds) * len(self.areaRng) * len(self.imgIds)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('evalImgs index out of range')
+        self._consolidate()
+        n = np.searchsorted(self.cells, index)
+        if n == len(self.cells) or self.cells[n] != index:
+            return None
+        d = slice(self.dtOffsets[n], self.dtOffsets[n + 1])
+        g = slice(self.gtOffsets[n], self.gtOffsets[n + 1])
+        view = self._header(index)
+        for f in self.viewFields:
+            v = getattr(self, f)[..., d if f.startswith('dt') else g]
+            view[f] = v.tolist() if f in self.listFields else v
+        return view
+
+    def __iadd__(self, evalImgs):
+        '''
+        Merge the results of another store with the same categories, area
+        ranges, maxDet and IoU thresholds; the image axis becomes the sorted
+        union of both and an image may only have results in one of them
+        '''
+        if (self.catIds != evalImgs.catIds
+                or not np.array_equal(self.areaRng, evalImgs.areaRng)
+                or self.maxDet != evalImgs.maxDet or self.T != evalImgs.T):
+            raise Exception('evalImgs with different params cannot be merged')
+        imgIds = sorted(set(self.imgIds) | set(evalImgs.imgIds))
+        chunks = [self._relabel(imgIds), evalImgs._relabel(imgIds)]
+        self.imgIds = imgIds
+        self._chunks = chunks[1:]
+        self._setChunk(chunks[0])
+        self._consolidate()
+        if np.any(np.diff(self.cells) == 0):
+            raise Exception('evalImgs of the same images cannot be merged')
+        return self
+
+    def __getstate__(self):
+        # copies and pickles of a spilled store keep their arrays in memory
+        self._consolidate()
+        state = dict(self.__dict__)
+        if self._spillDir is not None:
+            for f in self._fields():
+                state[f] = np.array(state[f])
+            state['_spillDir'] = None
+            del state['_removeSpilled']
+        return state
+
+    def spill(self, spillDir):
+        '''
+        Keep the arrays of the store in files in a new temporary directory
+        under spillDir, which is removed with the store, and map them back
+        into memory. Cells added after the stored ones are appended to the
+        files, others rewrite them.
+        :param spillDir (str): directory for the temporary directory
+        :return: None
+        '''
+        self._consolidate()
+        chunk = self._getChunk()
+        self._spillDir = tempfile.mkdtemp(prefix='evalImgs', dir=spillDir)
+        self._removeSpilled = weakref.finalize(self, shutil.rmtree,
+                                               self._spillDir, True)
+        self._setChunk(chunk)
+
+    def tobytes(self):
+        '''
+        Serialize the store into a compressed binary blob
+        :return: bytes
+        '''
+        self._consolidate()
+        chunk = self._getChunk()
+        buf = io.BytesIO()
+        np.savez_compressed(buf,
+                            imgIds=np.asarray(self.imgIds, dtype=np.int64),
+                            catIds=np.asarray(self.catIds, dtype=np.int64),
+                            areaRng=np.asarray(self.areaRng, dtype=float),
+                            maxDet=self.maxDet,
+                            T=self.T,
+                            **chunk)
+        return buf.getvalue()
+
+    @classmethod
+    def frombytes(cls, blob):
+        '''
+        Load a store serialized with tobytes()
+        :param blob: bytes
+        :return: evalImgs (obj)
+        '''
+        data = np.load(io.BytesIO(blob))
+        evalImgs = cls(data['imgIds'].tolist(), data['catIds'].tolist(),
+                       data['areaRng'].tolist(), int(data['maxDet']),
+                       int(data['T']))
+        evalImgs._setChunk({f: data[f] for f in data.files})
+        return evalImgs
+
+    def extend(self, cells, evalImgs):
+        '''
+        Add evaluateImg results stored at the given cell positions;
+        None results are skipped
+        :return: None
+        '''
+        self._chunks.append(self._packChunk(cells, evalImgs))
+
+    def _merge(self, evalImgs):
+        # add the cells of a store over a subset of the images of this one
+        self._chunks.append(evalImgs._relabel(self.imgIds))
+
+    def gatherSetting(self, k, a, maxDet, imgMask=None):
+        '''
+        Find the packed entries of the stored cells of the category and
+        area range at positions k and a: the cells of a setting are a range
+        of the sorted cells, found without listing the cells of its images
+        :param imgMask: [I] bool mask of the images to gather, None for all
+        :return: dind [N] indices of the first maxDet dts of every cell (all
+                 dts if maxDet is None), gind [M] indices of their gts,
+                 number of stored cells
+        '''
+        self._consolidate()
+        I0 = len(self.imgIds)
+        start = (k * len(self.areaRng) + a) * I0
+        lo, hi = np.searchsorted(self.cells, [start, start + I0])
+        n = np.arange(lo, hi)
+        if imgMask is not None:
+            n = n[imgMask[self.cells[n] - start]]
+        return self._gatherCells(n, maxDet)
+
+    def _gatherCells(self, n, maxDet):
+        # packed entries of the stored cells at indices n (see gatherSetting)
+        dtCounts = np.diff(self.dtOffsets)[n]
+        if maxDet is not None:
+            dtCounts = np.minimum(dtCounts, maxDet)
+        gtCounts = np.diff(self.gtOffsets)[n]
+        return (segmentIndex(self.dtOffsets[n], dtCounts),
+                segmentIndex(self.gtOffsets[n], gtCounts), len(n))
+
+    def _header(self, index):
+        # the keys of the dict view identifying the cell at index
+        A0, I0 = len(self.areaRng), len(self.imgIds)
+        return {
+            'image_id': self.imgIds[index % I0],
+            'category_id': self.catIds[index // (A0 * I0)],
+            'aRng': self.areaRng[index // I0 % A0],
+            'maxDet': self.maxDet,
+        }
+
+    def _packChunk(self, cells, evalImgs):
+        # pack a list of evaluateImg dicts into one chunk of arrays
+        keep = [n for n, e in enumerate(evalImgs) if e is not None]
+        E = [evalImgs[n] for n in keep]
+        dtCounts = [len(e[self.dtFields[0]]) for e in E]
+        gtCounts = [len(e[self.gtFields[0]]) for e in E]
+        chunk = {
+            'cells': np.array([cells[n] for n in keep], dtype=np.int64),
+            'dtCounts': np.array(dtCounts, dtype=np.int64),
+            'gtCounts': np.array(gtCounts, dtype=np.int64),
+        }
+        for f in self.dtFields + self.gtFields:
+            chunk[f] = np.concatenate(
+                [np.zeros(0, self.dtypes[f])] +
+                [np.asarray(e[f], dtype=self.dtypes[f]) for e in E])
+        for f in self.dtThrFields + self.gtThrFields:
+            chunk[f] = np.concatenate(
+                [np.zeros((self.T, 0), self.dtypes[f])] +
+                [np.asarray(e[f], dtype=self.dtypes[f]) for e in E],
+                axis=1)
+        return chunk
+
+    def _getChunk(self):
+        # the consolidated arrays as a chunk
+        chunk = {f: getattr(self, f) for f in self._fields()}
+        chunk['cells'] = self.cells
+        chunk['dtCounts'] = np.diff(self.dtOffsets)
+        chunk['gtCounts'] = np.diff(self.gtOffsets)
+        return chunk
+
+    def _setChunk(self, chunk):
+        if self._spillDir is not None:
+            return self._spillChunk(chunk)
+        for f in self._fields():
+            setattr(self, f, chunk[f])
+        self.cells = chunk['cells']
+        dtCounts, gtCounts = chunk['dtCounts'], chunk['gtCounts']
+        self.dtOffsets = np.concatenate([[0],
+                                         np.cumsum(dtCounts)]).astype(np.int64)
+        self.gtOffsets = np.concatenate([[0],
+                                         np.cumsum(gtCounts)]).astype(np.int64)
+
+    def _fields(self):
+        return (self.dtFields + self.dtThrFields + self.gtFields +
+                self.gtThrFields)
+
+    def _consolidate(self):
+        # concatenate pending chunks and sort cells by position
+        if not self._chunks:
+            return
+        chunks, self._chunks = self._chunks, []
+        if self._spillDir is not None:
+            chunk = self._concatChunks(chunks)
+            if (len(self.cells) == 0 or len(chunk['cells']) == 0
+                    or chunk['cells'][0] > self.cells[-1]):
+                return self._spillChunk(chunk, append=True)
+            chunks = [chunk]
+        self._setChunk(self._concatChunks([self._getChunk()] + chunks))
+
+    def _concatChunks(self, chunks):
+        # one chunk of the cells of chunks sorted by position; the fields
+        # are moved out of chunks into their place one chunk at a time, so
+        # that the copy of a field never holds its chunks twice
+        sizes = {
+            x: np.array([np.sum(c[x + 'Counts']) for c in chunks],
+                        dtype=np.int64)
+            for x in ('dt', 'gt')
+        }
+        chunk = {
+            f: np.concatenate([c.pop(f) for c in chunks])
+            for f in ('cells', 'dtCounts', 'gtCounts')
+        }
+        order = np.argsort(chunk['cells'], kind='mergesort')
+        pos = {'dt': None, 'gt': None}
+        if np.any(order != np.arange(len(order))):
+            for x in pos:
+                counts = chunk[x + 'Counts']
+                ind = segmentIndex((np.cumsum(counts) - counts)[order],
+                                   counts[order])
+                # sorted position of each entry
+                pos[x] = np.empty_like(ind)
+                pos[x][ind] = np.arange(len(ind))
+            for f in chunk:
+                chunk[f] = chunk[f][order]
+        for f in self._fields():
+            x = f[:2]
+            if pos[x] is None:
+                chunk[f] = np.concatenate([c.pop(f) for c in chunks], axis=-1)
+                continue
+            chunk[f] = np.empty(chunks[0][f].shape[:-1] + (len(pos[x]), ),
+                                dtype=self.dtypes[f])
+            ends = np.cumsum(sizes[x])
+            for c, s, e in zip(chunks, ends - sizes[x], ends):
+                chunk[f][..., pos[x][s:e]] = c.pop(f)
+        return chunk
+
+    def _spillChunk(self, chunk, append=False):
+        # write the arrays of a chunk to the files of a spilled store (after
+        # the stored ones if append) and map the files back
+        thrFields = self.dtThrFields + self.gtThrFields
+        for f in self._fields():
+            path = os.path.join(self._spillDir, f)
+            a = np.ascontiguousarray(
+                chunk[f].T if f in thrFields else chunk[f],
+                dtype=self.dtypes[f])
+            if append:
+                with open(path, 'ab') as fh:
+                    fh.write(a.data)
+            else:
+                # the replaced file stays valid while it is mapped
+                with open(path + '.tmp', 'wb') as fh:
+                    fh.write(a.data)
+                os.replace(path + '.tmp', path)
+        cells, dtCounts, gtCounts = (chunk['cells'], chunk['dtCounts'],
+                                     chunk['gtCounts'])
+        if append:
+            cells = np.concatenate([self.cells, cells])
+            dtCounts = np.concatenate([np.diff(self.dtOffsets), dtCounts])
+            gtCounts = np.concatenate([np.diff(self.gtOffsets), gtCounts])
+        self.cells = cells
+        self.dtOffsets = np.concatenate([[0],
+                                         np.cumsum(dtCounts)]).astype(np.int64)
+        self.gtOffsets = np.concatenate([[0],
+                                         np.cumsum(gtCounts)]).astype(np.int64)
+        for f in self._fields():
+            n = self.dtOffsets[-1] if f.startswith(
+                'dt') else self.gtOffsets[-1]
+            shape = (n, self.T) if f in thrFields else (n, )
+            if n == 0:
+                a = np.zeros(shape, dtype=self.dtypes[f])
+            else:
+                a = np.memmap(os.path.join(self._spillDir, f),
+                              dtype=self.dtypes[f],
+                              mode='r',
+                              shape=shape)
+            setattr(self, f, a.T if f in thrFields else a)
+
+    def _relabel(self, imgIds):
+        '''
+        Consolidated arrays as a chunk whose cell positions refer to the
+        layout with the image axis imgIds (a superset of self.imgIds)
+        '''
+        self._consolidate()
+        chunk = self._getChunk()
+        I0 = len(self.imgIds)
+        pos = {imgId: i for i, imgId in enumerate(imgIds)}
+        imgPos = np.array([pos[imgId] for imgId in self.imgIds],
+                          dtype=np.int64)
+        ka, i = self.cells // I0, self.cells % I0
+        chunk['cells'] = ka * len(imgIds) + imgPos[i]
+        return chunk
+
+
+def _emptyPacked(fields):
+    # packed arrays of no anns (see COCOeval._packAnns)
+    packed = {f: np.zeros(0, dtype=dtype) for f, dtype in fields.items()}
+    packed['bbox'] = packed['bbox'].reshape((0, 4))
+    packed['anns'] = []
+    return packed
+
+
+def _ranks(ids, values):
+    # rank of each of ids in values (of the last if repeated), -1 if not
+    # in values
+    ids, values = np.asarray(ids), np.asarray(values)
+    if ids.dtype.kind == values.dtype.kind == 'i':
+        order = np.argsort(values, kind='stable')
+        pos = np.searchsorted(values[order], ids, side='right') - 1
+        found = (pos >= 0) & (values[order][pos] == ids)
+        return np.where(found, order[pos], -1)
+    rank = {v: i for i, v in enumerate(values.tolist())}
+    return np.array([rank.get(i, -1) for i in ids.tolist()], dtype=np.int64)
+
+
+def _copyParams(p):
+    '''
+    Copy params as evaluated, for COCOeval._paramsEval: lists and arrays are
+    copied, but not the numbers in them one by one as deepcopy does (such
+    as the numpy ints of imgIds)
+    :return: params (obj)
+    '''
+    q = copy.copy(p)
+    for k, v in vars(p).items():
+        if isinstance(v, (list, np.ndarray)):
+            setattr(q, k, copy.copy(v))
+    if isinstance(p.areaRng, list):
+        # the ranges are lists themselves
+        q.areaRng = [copy.copy(aRng) for aRng in p.areaRng]
+    return q
+
+
+def _evaluateShard(args):
+    '''
+    Worker for COCOeval._evaluateCatsParallel
+    :param args: the COCOeval of a shard and the category positions
+    :return: ious and evalImgs of the shard
+    '''
+    cocoEval, ks = args
+    p = cocoEval.params
+    cocoEval.evalImgs = EvalImgs(p.imgIds, p.catIds if p.useCats else [-1],
+                                 p.areaRng, p.maxDets[-1], len(p.iouThrs))
+    cocoEval._evaluateCats(ks)
+    return cocoEval.ious, cocoEval.evalImgs
+
+
 class Params:
     '''
     Params for coco evaluation api
@@ -847,5 +1733,14 @@ class Params:
             raise Exception('iouType not supported')
         self.iouType = iouType
         self.lrp_size_details = lrp_size_details
+        # 'vectorized' or 'loop', both give identical matches
+        self.matcher = 'vectorized'
+        # ious of blocks with at least this many pairs are kept sparse
+        self.sparseIouMin = 4096
+        # keep all ious in COCOeval.ious, not only one image's at a time
+        self.keepIous = 0
+        # evaluate out of core in this directory if set (see COCOeval)
+        self.spillDir = None
+        self.spillCats = 16
         # useSegm is deprecated
         self.useSegm = None
@@ -0,0 +1,265 @@
+import numpy as np
+
+# NumPy kernels shared by the COCO and LVIS evaluation APIs.
+#
+# The evaluators work on small per (image, category) problems, which makes
+# plain Python loops over detections, ground truths and IoU thresholds the
+# dominant cost. The kernels below express those steps as array operations
+# and reproduce the reference loops in COCOeval/LVISEval exactly, including
+# their tie-breaking rules.
+#
+# The following API functions are defined:
+#  bboxIou          - Compute intersection over union between boxes.
+#  bboxOverlaps     - Sparse bboxIou, listing only the overlapping pairs.
+#  denseIous        - Expand sparse ious into a [DxG] matrix.
+#  segmentIndex     - Concatenate index ranges given by starts and counts.
+#  greedyMatch      - Match dts to gts for all IoU thresholds at once.
+#  accumulateCurves - Precision/recall curves and oLRP of one setting.
+#
+# Usage:
+#  ious = bboxIou( dt, gt, iscrowd )
+#  ious = bboxOverlaps( dt, gt, iscrowd )
+#  ious = denseIous( ious, D, G )
+#  inds = segmentIndex( starts, counts )
+#  dtm, gtm, dtIg, dtIoU = greedyMatch( ious, iouThrs, gtIg, iscrowd,
+#                                       dtIds, gtIds )
+#  precision, recall, scores, lrp = accumulateCurves( dtm, dtIg, dtIoU,
+#                                       dtScores, npig, recThrs, tau )
+#
+# In the API the following formats are used:
+#  dt,gt   - [Dx4] and [Gx4] bounding boxes stored as [x y w h]
+#  ious    - [DxG] IoU between score-sorted dts and ignore-last sorted gts,
+#            or the sparse triple (d, g, iou) of [P] arrays listing only the
+#            pairs of dt d and gt g that overlap, in row-major order
+#  iouThrs - [T] IoU thresholds
+#  gtIg    - [G] ignore flag for each gt, or [AxG] one row per area range
+#  iscrowd - [G] crowd flag for each gt (crowd gts can be matched repeatedly)
+#  dtIds   - [D] id of each dt
+#  gtIds   - [G] id of each gt
+#  recThrs - [R] recall thresholds
+#  npig    - number of non-ignored gts of the evaluated setting
+#  tau     - IoU threshold of LRP (the first of iouThrs)
+
+
+def bboxIou(dt, gt, iscrowd):
+    '''
+    Compute the [DxG] intersection over union between boxes, with the
+    same arithmetic as bbIou in maskApi.c, so that the results equal
+    mask.iou on boxes. For crowd gts the intersection is divided by the
+    area of the dt instead of the union (see mask.py).
+    '''
+    dt = np.asarray(dt, dtype=np.float64).reshape((-1, 4))[:, None, :]
+    gt = np.asarray(gt, dtype=np.float64).reshape((-1, 4))[None, :, :]
+    crowd = np.asarray(iscrowd, dtype=bool).reshape((1, -1))
+    return _boxIou(dt, gt, crowd)[0]
+
+
+def bboxOverlaps(dt, gt, iscrowd):
+    '''
+    Compute bboxIou for the overlapping pairs of boxes only, so that time
+    and memory scale with the number of overlaps instead of D*G. The gts
+    are swept along the axis giving fewer candidates: sorted by their
+    left (top) edge, the gts that can overlap a dt form a window starting
+    at the dt's left edge minus the widest gt and ending at its right edge.
+    Pairs missing from the result have IoU 0 in bboxIou.
+    :return: sparse ious (d, g, iou) in row-major order
+    '''
+    dt = np.asarray(dt, dtype=np.float64).reshape((-1, 4))
+    gt = np.asarray(gt, dtype=np.float64).reshape((-1, 4))
+    crowd = np.asarray(iscrowd, dtype=bool).reshape(-1)
+    D, G = len(dt), len(gt)
+    if D == 0 or G == 0 or not (np.isfinite(dt).all()
+                                and np.isfinite(gt).all()):
+        d, g = np.indices((D, G)).reshape((2, -1))
+    else:
+        order, lo, hi = min((_sweep(dt, gt, 0), _sweep(dt, gt, 1)),
+                            key=lambda w: np.maximum(w[2] - w[1], 0).sum())
+        n = np.maximum(hi - lo, 0)
+        d = np.repeat(np.arange(D), n)
+        g = order[segmentIndex(lo, n)]
+        # drop the candidates that do not overlap before sorting them
+        keep = _boxIou(dt[d], gt[g], crowd[g])[1]
+        d, g = d[keep], g[keep]
+        s = np.argsort(d * G + g)
+        d, g = d[s], g[s]
+    iou, overlap = _boxIou(dt[d], gt[g], crowd[g])
+    return d[overlap], g[overlap], iou[overlap]
+
+
+def denseIous(ious, D, G):
+    '''
+    Expand sparse ious (d, g, iou) into the [DxG] matrix of bboxIou.
+    '''
+    d, g, iou = ious
+    dense = np.zeros((D, G))
+    dense[d, g] = iou
+    return dense
+
+
+def segmentIndex(starts, counts):
+    '''
+    Concatenation of arange(s, s + c) for every segment (s, c), used to
+    gather variable length slices of packed arrays at once.
+    '''
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+        starts - (ends - counts), counts)
+
+
+def _boxIou(dt, gt, crowd):
+    '''
+    Elementwise bbIou of broadcastable [...x4] boxes.
+    :return: ious and the mask of the pairs with a positive overlap
+    '''
+    da = dt[..., 2] * dt[..., 3]
+    ga = gt[..., 2] * gt[..., 3]
+    w = (np.fmin(dt[..., 2] + dt[..., 0], gt[..., 2] + gt[..., 0]) -
+         np.fmax(dt[..., 0], gt[..., 0]))
+    h = (np.fmin(dt[..., 3] + dt[..., 1], gt[..., 3] + gt[..., 1]) -
+         np.fmax(dt[..., 1], gt[..., 1]))
+    i = w * h
+    u = np.where(crowd, da, da + ga - i)
+    overlap = (w > 0) & (h > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(overlap, i / u, 0.), overlap
+
+
+def _sweep(dt, gt, axis):
+    '''
+    Window [lo, hi) of the gts sorted along axis (0 for x, 1 for y) that a
+    dt can overlap: a gt ending after the dt's start cannot start before
+    it minus the widest gt, and the window is widened by an ulp to stay
+    exact under the rounding of that bound.
+    :return: order of the gts, lo [D] and hi [D]
+    '''
+    order = np.argsort(gt[:, axis], kind='mergesort')
+    start = gt[order, axis]
+    size = max(gt[:, axis + 2].max(), 0.)
+    lo = np.searchsorted(start,
+                         np.nextafter(dt[:, axis] - size, -np.inf),
+                         side='left')
+    hi = np.searchsorted(start, dt[:, axis + 2] + dt[:, axis], side='left')
+    return order, lo, hi
+
+
+def greedyMatch(ious, iouThrs, gtIg, iscrowd, dtIds, gtIds):
+    '''
+    Greedily match detections to ground truths for every IoU threshold.
+    Detections are visited in score order; each takes the available gt
+    with the highest IoU (the last one on ties), preferring regular gts
+    over ignored ones, exactly as the loop in COCOeval.evaluateImg does.
+    Only the loop over detections is left in Python. With sparse ious
+    each dt only visits the gts it overlaps, which is exact as long as
+    all iouThrs are positive (otherwise the ious are made dense).
+    If gtIg is [AxG] (one ignore row per area range), all A matchings are
+    solved in the same pass and gts need not be sorted ignore-last: the
+    stable ignore-last sort never changes the order within either group.
+    :return: dtm [TxD] matched gt id or 0, gtm [TxG] matched dt id or 0,
+             dtIg [TxD] ignore flag of the matched gt, dtIoU [TxD] IoUs
+             (each with a leading A axis if gtIg is [AxG])
+    '''
+    gtIg = np.asarray(gtIg, dtype=bool)
+    shape = gtIg.shape[:-1] + (len(iouThrs), )
+    A, T, D, G = int(np.prod(shape[:-1])), len(iouThrs), len(dtIds), len(gtIds)
+    gtIg = gtIg.reshape((A, G))
+    dtm = np.zeros((A * T, D))
+    gtm = np.zeros((A * T, G))
+    dtIg = np.zeros((A * T, D))
+    dtIoU = np.zeros((A * T, D))
+    if isinstance(ious, tuple) and np.min(iouThrs) <= 0:
+        # pairs without overlap only match at a threshold of 0
+        ious = denseIous(ious, D, G)
+    if isinstance(ious, tuple):
+        # the candidate gts of each dt are the ones it overlaps
+        dInd, gInd, vals = ious
+        ptr = np.searchsorted(dInd, np.arange(D + 1))
+        rows = [(gInd[s:e], vals[s:e]) for s, e in zip(ptr[:-1], ptr[1:])]
+    else:
+        cols = np.arange(G)
+        rows = [(cols, iou) for iou in ious]
+    # one row per (area range, threshold) pair
+    thrs = np.tile(np.minimum(np.asarray(iouThrs), 1 - 1e-10), A)[:, None]
+    gtIg = np.repeat(gtIg, T, axis=0)
+    crowd = np.asarray(iscrowd, dtype=bool)
+    gtIds = np.asarray(gtIds)
+    t = np.arange(A * T)
+    for d, (cols, iou) in enumerate(rows):
+        # detections below the lowest threshold everywhere can never match
+        if len(iou) == 0 or not iou.max() >= thrs.min():
+            continue
+        # matched gts are skipped unless they are crowd regions
+        cand = (iou >= thrs) & ((gtm[:, cols] <= 0) | crowd[cols])
+        # once a regular gt is matched, ignored gts are never considered
+        reg = cand & ~gtIg[:, cols]
+        cand = np.where(reg.any(axis=1, keepdims=True), reg, cand)
+        has = cand.any(axis=1)
+        if not has.any():
+            continue
+        # last index of the best IoU, as the loop keeps replacing on ties
+        best = len(cols) - 1 - np.argmax(np.where(cand, iou, -np.inf)[:, ::-1],
+                                         axis=1)
+        m = cols[best[has]]
+        dtIg[t[has], d] = gtIg[t[has], m]
+        dtm[t[has], d] = gtIds[m]
+        gtm[t[has], m] = dtIds[d]
+        dtIoU[t[has], d] = iou[best[has]]
+    return (dtm.reshape(shape + (D, )), gtm.reshape(shape + (G, )),
+            dtIg.reshape(shape + (D, )), dtIoU.reshape(shape + (D, )))
+
+
+def accumulateCurves(dtm, dtIg, dtIoU, dtScores, npig, recThrs, tau):
+    '''
+    Accumulate the matches of one (category, area range, maxDet) setting,
+    given for score sorted dts, into precision/recall curves for all IoU
+    thresholds and the optimal LRP at the first threshold.
+    The precision envelope is a reversed running maximum and the recall
+    threshold lookup is done for all T rows by counting, for each recall
+    threshold, the dts whose recall is below it; the results are identical
+    to np.searchsorted(rc, recThrs, side='left') row by row.
+    :return: precision [TxR], recall [T], scores [TxR] and the tuple
+             (olrp, olrpLoc, olrpFp, olrpFn, lrpOptThr)
+    '''
+    T, N = dtm.shape
+    R = len(recThrs)
+    tps = np.logical_and(dtm, np.logical_not(dtIg))
+    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg))
+    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+    # oLRP is 1 and its components undefined without any TP
+    noTp = (1., np.nan, np.nan, 1., np.nan)
+    if N == 0:
+        return np.zeros((T, R)), np.zeros(T), np.zeros((T, R)), noTp
+    rc = tp_sum / npig
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # replace each precision by the maximum precision to its right
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    # inds[t, r] = number of dts with rc[t] < recThrs[r]; a dt is below
+    # the recall thresholds from the first one exceeding its recall on
+    order = np.argsort(recThrs, kind='mergesort')
+    first = np.searchsorted(np.asarray(recThrs)[order], rc, side='right')
+    below = np.bincount((np.arange(T)[:, None] * (R + 1) + first).ravel(),
+                        minlength=T * (R + 1)).reshape((T, R + 1))
+    inds = np.empty((T, R), dtype=np.int64)
+    inds[:, order] = np.cumsum(below, axis=1)[:, :R]
+    # recall thresholds beyond the reached recall keep precision 0, as do
+    # all thresholds after the first such one (recThrs need not be sorted)
+    valid = np.logical_and.accumulate(inds < N, axis=1)
+    inds = np.minimum(inds, N - 1)
+    precision = np.where(valid, np.take_along_axis(pr, inds, axis=1), 0)
+    scores = np.where(valid, dtScores[inds], 0)
+
+    # oLRP and Opt.Thr. from the same cumulative sums
+    tp_num = tp_sum[0]
+    fp_num = fp_sum[0]
+    fn_num = npig - tp_num
+    if tp_num[-1] == 0:
+        return precision, rc[:, -1], scores, noTp
+    total_loc = tp_num - np.cumsum(np.multiply(dtIoU[0], tps[0]))
+    total = tp_num + fp_num + fn_num
+    lrps = (total_loc / (1 - tau) + fp_num + fn_num) / total
+    opt_pos_idx = np.argmin(lrps)
+    lrp = (lrps[opt_pos_idx], total_loc[opt_pos_idx] / tp_num[opt_pos_idx],
+           fp_num[opt_pos_idx] / (tp_num[opt_pos_idx] + fp_num[opt_pos_idx]),
+           fn_num[opt_pos_idx] / npig, dtScores[opt_pos_idx])
+    return precision, rc[:, -1], scores, lrp
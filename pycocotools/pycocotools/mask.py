@@ -1,6 +1,17 @@
 __author__ = 'tsungyi'
 
-import pycocotools._mask as _mask
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+from .kernels import bboxIou, bboxOverlaps
+
+try:
+    import pycocotools._mask as _mask
+except ImportError:
+    # not compiled, only the iou of boxes is available (see below)
+    _mask = None
 
 # Interface for manipulating masks stored in RLE format.
 #
@@ -32,19 +43,23 @@ import pycocotools._mask as _mask
 #  decode         - Decode binary masks encoded via RLE.
 #  merge          - Compute union or intersection of encoded masks.
 #  iou            - Compute intersection over union between masks.
+#  sparseIou      - Compute iou only between masks whose boxes overlap.
 #  area           - Compute area of encoded masks.
 #  toBbox         - Get bounding boxes surrounding encoded masks.
 #  frPyObjects    - Convert polygon, bbox, and uncompressed RLE
 #                   to encoded RLE mask.
+#  frSegmentations - Convert segmentations of many anns in parallel.
 #
 # Usage:
 #  Rs     = encode( masks )
 #  masks  = decode( Rs )
 #  R      = merge( Rs, intersect=false )
 #  o      = iou( dt, gt, iscrowd )
+#  d,g,o  = sparseIou( dt, gt, iscrowd, dtBbs=None, gtBbs=None )
 #  a      = area( Rs )
 #  bbs    = toBbox( Rs )
 #  Rs     = frPyObjects( [pyObjects], h, w )
+#  Rs     = frSegmentations( segms, sizes, num_workers=1 )
 #
 # In the API the following formats are used:
 #  Rs      - [dict] Run-length encoding of binary masks
@@ -56,6 +71,8 @@ import pycocotools._mask as _mask
 #  bbs     - [nx4] Bounding box(es) stored as [x y w h]
 #  poly    - Polygon stored as [[x1 y1 x2 y2...],[x1 y1 ...],...] (2D list)
 #  dt,gt   - May be either bounding boxes or encoded masks
+#  segms   - [n] ann segmentations (poly, uncompressed or encoded RLE)
+#  sizes   - [nx2] (h, w) of the image of each segmentation
 # Both poly and bbs are 0-indexed (bbox=[0 0 1 1] encloses first pixel).
 #
 # Finally, a note about the intersection over union (iou) computation.
@@ -69,16 +86,48 @@ import pycocotools._mask as _mask
 # For crowd gt regions we use this modified criteria above for the iou.
 #
 # To compile run "python setup.py build_ext --inplace"
-# Please do not contact us for help with compiling.
+# Please do not contact us for help with compiling. Without compiling,
+# iou is computed in NumPy and only supports bounding boxes, so that bbox
+# evaluation still works; the other functions raise an ImportError.
 #
 # Microsoft COCO Toolbox.      version 2.0
 # Data, paper, and tutorials available at:  http://mscoco.org/
 # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
 # Licensed under the Simplified BSD License [see coco/license.txt]
 
-iou = _mask.iou
-merge = _mask.merge
-frPyObjects = _mask.frPyObjects
+
+def _notCompiled(*args, **kwargs):
+    raise ImportError('pycocotools._mask is not compiled, run '
+                      '"python setup.py build_ext --inplace"')
+
+
+class _NotCompiled:
+    # stands in for _mask if it is not compiled
+    def __getattr__(self, name):
+        return _notCompiled
+
+
+def _boxIou(dt, gt, iscrowd):
+    # iou of bounding boxes given as [nx4] arrays or lists of [x y w h]
+    if len(dt) == 0 or len(gt) == 0:
+        return []
+    dt, gt = np.asarray(dt), np.asarray(gt)
+    if not all(o.dtype.kind in 'iuf' and o.ndim <= 2 and o.shape[-1] == 4
+               for o in (dt, gt)):
+        raise ImportError('pycocotools._mask is not compiled, '
+                          'iou is only supported for bounding boxes')
+    return bboxIou(dt, gt, iscrowd)
+
+
+if _mask is not None:
+    iou = _mask.iou
+    merge = _mask.merge
+    frPyObjects = _mask.frPyObjects
+else:
+    _mask = _NotCompiled()
+    iou = _boxIou
+    merge = _mask.merge
+    frPyObjects = _mask.frPyObjects
 
 
 def encode(bimask):
@@ -108,3 +157,68 @@ def toBbox(rleObjs):
         return _mask.toBbox(rleObjs)
     else:
         return _mask.toBbox([rleObjs])[0]
+
+
+def sparseIou(dt, gt, iscrowd, dtBbs=None, gtBbs=None):
+    '''
+    Compute iou between the encoded masks dt and gt whose bounding boxes
+    overlap, the only pairs with a nonzero iou, so that masks overlapping
+    nothing are not decoded. The boxes default to toBbox(dt), toBbox(gt).
+    :return: sparse ious (d, g, o) of the pairs of dt d and gt g that
+             overlap, in row-major order (see kernels.bboxOverlaps)
+    '''
+    if dtBbs is None:
+        dtBbs = toBbox(dt)
+    if gtBbs is None:
+        gtBbs = toBbox(gt)
+    d, g, _ = bboxOverlaps(dtBbs, gtBbs, iscrowd)
+    if len(d) == 0:
+        return d, g, np.zeros(0)
+    rows, dRow = np.unique(d, return_inverse=True)
+    cols, gCol = np.unique(g, return_inverse=True)
+    o = iou([dt[i] for i in rows], [gt[j] for j in cols],
+            np.asarray(iscrowd)[cols])
+    return d, g, o[dRow, gCol]
+
+
+def frSegmentations(segms, sizes, num_workers=1):
+    '''
+    Convert the segmentations of anns to encoded RLE masks as annToRLE
+    does: the polygons of an ann are merged into one mask, uncompressed
+    RLEs are encoded and encoded RLEs are returned as they are. The anns
+    are grouped by image size and the groups, split in a few tasks per
+    worker, are converted in num_workers processes.
+    :return: Rs in the order of segms
+    '''
+    groups = defaultdict(list)
+    for i, (segm, size) in enumerate(zip(segms, sizes)):
+        if isinstance(segm, list) or isinstance(segm['counts'], list):
+            groups[tuple(size)].append(i)
+    tasks, taskInds = [], []
+    for (h, w), inds in groups.items():
+        n = -(-len(inds) // (num_workers * 4))
+        for s in range(0, len(inds), n):
+            tasks.append(([segms[i] for i in inds[s:s + n]], h, w))
+            taskInds.append(inds[s:s + n])
+    if num_workers > 1 and len(tasks) > 1:
+        workers = multiprocessing.Pool(processes=num_workers)
+        results = workers.map(_frSegmentations, tasks, chunksize=1)
+        workers.close()
+        workers.join()
+    else:
+        results = [_frSegmentations(task) for task in tasks]
+    Rs = list(segms)
+    for inds, rles in zip(taskInds, results):
+        for i, rle in zip(inds, rles):
+            Rs[i] = rle
+    return Rs
+
+
+def _frSegmentations(task):
+    # convert the segmentations of a task of frSegmentations
+    segms, h, w = task
+    return [
+        merge(frPyObjects(segm, h, w))
+        if isinstance(segm, list) else frPyObjects(segm, h, w)
+        for segm in segms
+    ]
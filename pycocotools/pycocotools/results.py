@@ -0,0 +1,286 @@
+import gc
+import json
+import re
+import warnings
+
+import numpy as np
+
+from . import mask as maskUtils
+
+# Loader of result files for COCO.loadRes.
+#
+# json.load holds the whole text of a result file while it builds a dict
+# per result, and result files with hundreds of detections per image run
+# into gigabytes. loadResults instead reads the file a chunk at a time and
+# decodes the results of each chunk at once, so that only one chunk of the
+# text is held next to the results. The fields loadRes adds (area, id, ...)
+# are computed for a chunk of results at a time from arrays of the fields
+# they derive from, rather than one result at a time, except the areas of
+# bboxes: they are the products of the numbers of each bbox, so that they
+# are ints for bboxes of ints even among floats. Bbox results with
+# no other fields are also packed into columns of numbers by bboxColumns,
+# which COCOeval evaluates bboxes from without going through the dicts
+# (see COCO.loadRes).
+#
+# The following API functions are defined:
+#  loadResults     - Load and finalize the results of a result file.
+#  finalizeResults - Add the fields loadRes adds to a list of results.
+#  finalizeColumns - Add the fields loadRes adds to columns of bbox results.
+#  bboxColumns     - Pack finalized bbox results into columns.
+#  resultType      - Get the type of results from the first result.
+#  annSegmentation - Get the segmentation of an ann or of its bbox.
+#
+# Usage:
+#  anns = loadResults( resFile )
+#  finalizeResults( anns, resultType( anns[0] ), firstId=1 )
+#  columns = finalizeColumns( columns, firstId=1 )
+#  columns = bboxColumns( anns )
+#  segm = annSegmentation( ann )
+#
+# Each result type has a field the finalize step derives the others from:
+#  caption      - the ids only
+#  bbox         - area from the bbox
+#  segmentation - area, bbox (if missing) from the RLE segmentation
+#  keypoints    - area, bbox from the box enclosing the keypoints
+# Results whose keypoints do not fit in one array (such as lists of
+# different lengths) are finalized one at a time. Columns of bbox
+# results are numpy arrays of the fields image_id, category_id (int64),
+# score (float64) and bbox ([nx4] float64), to which finalizeColumns adds
+# area, id and iscrowd. Bbox results are not given the polygon of their
+# bbox as segmentation, which only segm evaluation and showAnns read:
+# annSegmentation makes it when they do.
+
+_space = re.compile(r'[ \t\n\r]*')
+_bboxFields = {
+    'image_id', 'category_id', 'bbox', 'score', 'area', 'id', 'iscrowd'
+}
+
+
+def resultType(ann):
+    '''
+    Get the type of results as loadRes determines it from the first result.
+    :param ann (dict): first result
+    :return: type (str): 'caption', 'bbox', 'segmentation', 'keypoints' or
+             None if the result is none of these
+    '''
+    if 'caption' in ann:
+        return 'caption'
+    elif 'bbox' in ann and not ann['bbox'] == []:
+        return 'bbox'
+    for kind in ['segmentation', 'keypoints']:
+        if kind in ann:
+            return kind
+    return None
+
+
+def annSegmentation(ann):
+    '''
+    Get the segmentation of an ann, or for anns without one (such as bbox
+    results) the polygon of its bbox.
+    :param ann (dict): annotation
+    :return: segm: polygons or RLE
+    '''
+    if 'segmentation' in ann:
+        return ann['segmentation']
+    x1, y1, w, h = ann['bbox']
+    x2, y2 = x1 + w, y1 + h
+    return [[x1, y1, x1, y2, x2, y2, x2, y1]]
+
+
+def finalizeResults(anns, kind, firstId=1):
+    '''
+    Add the fields loadRes adds to the results of the given type, in place.
+    :param anns (list): results
+    :param kind (str): type of the results (see resultType)
+    :param firstId (int): id of the first result, the others count up
+    :return: None
+    '''
+    ids = range(firstId, firstId + len(anns))
+    if kind == 'bbox':
+        # the areas of bboxes of ints stay ints, as loadRes computed them
+        _finalizeEach(anns, kind, firstId)
+    elif kind == 'segmentation':
+        # now only support compressed RLE format as segmentation results
+        areas = maskUtils.area([ann['segmentation'] for ann in anns])
+        bbs = iter(
+            maskUtils.toBbox(
+                [ann['segmentation'] for ann in anns if 'bbox' not in ann]))
+        for ann, area, id in zip(anns, areas.tolist(), ids):
+            ann['area'] = area
+            if 'bbox' not in ann:
+                ann['bbox'] = next(bbs)
+            ann['id'] = id
+            ann['iscrowd'] = 0
+    elif kind == 'keypoints':
+        kps = _numberRows([ann['keypoints'] for ann in anns])
+        if kps is None or kps.shape[1] == 0 or kps.shape[1] % 3:
+            return _finalizeEach(anns, kind, firstId)
+        x, y = kps[:, 0::3], kps[:, 1::3]
+        x0, x1, y0, y1 = x.min(1), x.max(1), y.min(1), y.max(1)
+        areas = ((x1 - x0) * (y1 - y0)).tolist()
+        bbs = np.stack([x0, y0, x1 - x0, y1 - y0], axis=1).tolist()
+        for ann, area, bb, id in zip(anns, areas, bbs, ids):
+            ann['area'] = area
+            ann['id'] = id
+            ann['bbox'] = bb
+    elif kind == 'caption':
+        for ann, id in zip(anns, ids):
+            ann['id'] = id
+
+
+def finalizeColumns(columns, firstId=1):
+    '''
+    Add the fields loadRes adds to columns of bbox results.
+    :param columns (dict): image_id, category_id, score and bbox arrays
+    :param firstId (int): id of the first result, the others count up
+    :return: columns (dict): the columns and area, id and iscrowd arrays
+    '''
+    n = len(columns['score'])
+    columns = dict(columns)
+    columns['area'] = columns['bbox'][:, 2] * columns['bbox'][:, 3]
+    columns['id'] = np.arange(firstId, firstId + n)
+    columns['iscrowd'] = np.zeros(n)
+    return columns
+
+
+def loadResults(resFile):
+    '''
+    Load the results of resFile a chunk at a time and add the fields loadRes
+    adds to each chunk of results (see above).
+    :param resFile (str): file name of result file
+    :return: anns (list): finalized results, or None if resFile is not an
+             array of objects, for json.load to report
+    '''
+    anns = []
+    # the collector would run over and over while the results are built
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(resFile) as f:
+            batches = _iterBatches(f)
+            while True:
+                try:
+                    batch = next(batches, None)
+                except ValueError:
+                    return None
+                if batch is None:
+                    return anns
+                if not all(isinstance(ann, dict) for ann in batch):
+                    return None
+                if not anns:
+                    kind = resultType(batch[0])
+                finalizeResults(batch, kind, len(anns) + 1)
+                anns += batch
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def bboxColumns(anns):
+    '''
+    Pack finalized bbox results into columns (see finalizeColumns). The
+    results themselves are left unchanged.
+    :param anns (list): bbox results finalized by finalizeResults
+    :return: columns (dict), or None unless every result has only the
+             fields of a bbox result, with numbers of the types the columns
+             hold
+    '''
+    if not all(ann.keys() == _bboxFields for ann in anns):
+        return None
+    imgIds = [ann['image_id'] for ann in anns]
+    catIds = [ann['category_id'] for ann in anns]
+    scores = [ann['score'] for ann in anns]
+    if not (all(type(i) is int
+                for i in imgIds) and all(type(i) is int for i in catIds)
+            and all(type(s) in (int, float) for s in scores)):
+        return None
+    bb = _numberRows([ann['bbox'] for ann in anns])
+    if bb is None or bb.shape[1] != 4:
+        return None
+    return {
+        'image_id': np.array(imgIds, dtype=np.int64),
+        'category_id': np.array(catIds, dtype=np.int64),
+        'score': np.array(scores, dtype=np.float64),
+        'bbox': bb.astype(np.float64),
+        'area': np.array([ann['area'] for ann in anns], dtype=np.float64),
+        'id': np.array([ann['id'] for ann in anns], dtype=np.int64),
+        'iscrowd': np.zeros(len(anns)),
+    }
+
+
+def _finalizeEach(anns, kind, firstId):
+    # finalizeResults one result at a time, for bboxes and keypoints only
+    for id, ann in enumerate(anns, firstId):
+        if kind == 'bbox':
+            bb = ann['bbox']
+            ann['area'] = bb[2] * bb[3]
+            ann['id'] = id
+            ann['iscrowd'] = 0
+        elif kind == 'keypoints':
+            s = ann['keypoints']
+            x = s[0::3]
+            y = s[1::3]
+            x0, x1, y0, y1 = np.min(x), np.max(x), np.min(y), np.max(y)
+            ann['area'] = (x1 - x0) * (y1 - y0)
+            ann['id'] = id
+            ann['bbox'] = [x0, y0, x1 - x0, y1 - y0]
+
+
+def _numberRows(values):
+    # [nxk] array of n lists of k numbers, None if values are not
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns of lists of different lengths
+            warnings.simplefilter('error')
+            a = np.array(values)
+    except (ValueError, Warning):
+        return None
+    if a.ndim != 2 or a.dtype.kind not in 'iuf':
+        return None
+    return a
+
+
+def _iterBatches(f, chunkSize=1 << 22):
+    '''
+    Decode the objects of the json array in file f a chunk of the file at a
+    time: the text read so far is cut after the last object that ends in it
+    and the objects before the cut are decoded at once.
+    :return: iterator over lists of objects, raises ValueError if f holds
+             anything else
+    '''
+    buf = f.read(chunkSize).lstrip(' \t\n\r')
+    if not buf.startswith('['):
+        raise ValueError('not an array')
+    buf = buf[1:]
+    while True:
+        more = f.read(chunkSize)
+        if not more:
+            batch = json.loads('[' + buf)
+            if batch:
+                yield batch
+            return
+        buf += more
+        cut = _lastObjectEnd(buf)
+        if cut is None:
+            continue
+        try:
+            batch = json.loads('[' + buf[:cut[0]] + ']')
+        except ValueError:
+            # cut in a string or a nested object, the next cut may not be
+            continue
+        buf = buf[cut[1]:]
+        yield batch
+
+
+def _lastObjectEnd(buf):
+    # end of the last '}' followed by ',' in buf and the start of the text
+    # after the ',', which is where buf can be cut if the '}' closes an
+    # element of the array, None if there is no such '}'
+    i = len(buf)
+    while True:
+        i = buf.rfind('}', 0, i)
+        if i < 0:
+            return None
+        j = _space.match(buf, i + 1).end()
+        if buf.startswith(',', j):
+            return i + 1, j + 1
@@ -25,5 +25,6 @@ setup(name='pycocotools',
       install_requires=[
           'setuptools>=18.0', 'cython>=0.27.3', 'matplotlib>=2.1.0'
       ],
-      version='2.0',
+      # the local label marks this fork, whose modules lvis-api imports
+      version='2.0+lrp',
       ext_modules=ext_modules)